@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+
+
+class LRUCache(Generic[K, V]):
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: Optional[float] = None,
+            clock: Callable[[], float] = monotonic,
+    ) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._clock = clock
+        self._data: OrderedDict[K, Tuple[V, Optional[float]]] = OrderedDict()
+        self._hits = self._misses = self._evictions = 0
+        self._lock = Lock()
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self._misses += 1
+                return None
+            if expires is not None and expires <= self._clock():
+                del self._data[key]
+                self._evictions += 1
+                self._misses += 1
+                return None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        expires = None if self._ttl is None else self._clock() + self._ttl
+        with self._lock:
+            self._data[key] = value, expires
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
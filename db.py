@@ -1,7 +1,94 @@
+import os
+import weakref
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Union
+
 from sqlalchemy import create_engine, MetaData
+from sqlalchemy.engine import Engine, make_url, URL
+from sqlalchemy.event import listen
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 
 metadata = MetaData()
 Base = declarative_base(metadata=metadata)
-memory_engine = create_engine('sqlite:///')
+
+_engines: 'weakref.WeakSet[Engine]' = weakref.WeakSet()
+
+
+@dataclass(frozen=True)
+class EngineSettings:
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_pre_ping: bool = True
+    pool_recycle: int = 3600
+    journal_mode: Optional[str] = 'WAL'
+    synchronous: Optional[str] = 'NORMAL'
+    cache_size: Optional[int] = -64_000
+    mmap_size: Optional[int] = 256 * 1024 * 1024
+    foreign_keys: Optional[str] = 'ON'
+
+    def pragmas(self) -> Dict[str, Any]:
+        pragmas = {
+            'journal_mode': self.journal_mode,
+            'synchronous': self.synchronous,
+            'cache_size': self.cache_size,
+            'mmap_size': self.mmap_size,
+            'foreign_keys': self.foreign_keys,
+        }
+        return {name: value for name, value in pragmas.items()
+                if value is not None}
+
+
+PRODUCTION = EngineSettings()
+IN_MEMORY = EngineSettings(
+    pool_pre_ping=False, pool_recycle=-1,
+    journal_mode=None, synchronous=None, cache_size=None, mmap_size=None,
+    foreign_keys=None,
+)
+
+
+def make_engine(
+        url: Union[str, URL], settings: EngineSettings = PRODUCTION,
+        **options: Any,
+) -> Engine:
+    url = make_url(url)
+    sqlite = url.get_backend_name() == 'sqlite'
+    options.setdefault('pool_pre_ping', settings.pool_pre_ping)
+    options.setdefault('pool_recycle', settings.pool_recycle)
+    if not (sqlite and url.database in (None, '', ':memory:')):
+        options.setdefault('pool_size', settings.pool_size)
+        options.setdefault('max_overflow', settings.max_overflow)
+    engine = create_engine(url, **options)
+
+    pragmas = settings.pragmas() if sqlite else {}
+    if pragmas:
+        def set_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+
+        listen(engine, 'connect', set_pragmas)
+    _engines.add(engine)
+    return engine
+
+
+def _dispose_after_fork() -> None:
+    for engine in list(_engines):
+        engine.dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_after_fork)
+
+
+def make_sessionmaker(engine: Engine, **options: Any) -> sessionmaker:
+    return sessionmaker(bind=engine, **options)
+
+
+def make_scoped_session(engine: Engine, **options: Any) -> scoped_session:
+    return scoped_session(make_sessionmaker(engine, **options))
+
+
+memory_engine = make_engine('sqlite:///', IN_MEMORY)
@@ -1,27 +1,283 @@
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type, Union
 
-from sqlalchemy.orm import Session
-from .model import Mapping
-from .platform import Identity
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Dialect
+from sqlalchemy.event import contains, listen
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, Session
+
+from utils import chunked
+from .cache import IdentityCache
+from .model import Mapping, TypedMapping
+from .platform import Identity, Platform
+
+Key = Tuple[Platform, bytes]
+Model = Union[Type[Mapping], Type[TypedMapping]]
+
+UPSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+CACHED = 'acl_cached_identities'
+WROTE = 'acl_wrote'
+
+
+def select_id(identity: Identity, model: Model = Mapping) -> sa.Select:
+    return sa.select(model.id).where(model.identity == identity)
+
+
+def select_identities(mapped_id: int, model: Model = Mapping) -> sa.Select:
+    return sa.select(*model.identity_columns()).where(
+        model.__table__.c.id == mapped_id,
+    )
+
+
+def forget_cached(target: Union[Session, Connection]) -> None:
+    target.info.pop(CACHED, None)
+    target.info.pop(WROTE, None)
+
+
+def invalidate_cached(target: Union[Session, Connection]) -> None:
+    cached = target.info.pop(CACHED, ())
+    if target.info.pop(WROTE, False):
+        for cache, mapped_id, identity in cached:
+            cache.invalidate(mapped_id, identity)
+
+
+@dataclass(frozen=True)
+class BulkResult:
+    inserted: int
+    skipped: int
 
 
 class Acl:
-    def __init__(self, session: Session) -> None:
+    def __init__(
+            self,
+            session: Union[Session, scoped_session, Connection],
+            chunk_size: int = 500,
+            cache: Optional[IdentityCache] = None,
+            core_reads: bool = False,
+            model: Model = Mapping,
+    ) -> None:
         self._session = session
+        self._model = model
+        self._table = model.__table__
+        self._chunk_size = chunk_size
+        self._cache = cache
+        self._orm = isinstance(session, (Session, scoped_session))
+        self._core_reads = core_reads or not self._orm
+        if cache:
+            commit, rollback = (
+                ('after_commit', 'after_rollback') if self._orm
+                else ('commit', 'rollback')
+            )
+            if not contains(session, commit, forget_cached):
+                listen(session, commit, forget_cached)
+                listen(session, rollback, invalidate_cached)
 
     def add(self, mapped_id: int, identity: Identity) -> None:
-        model = Mapping(id=mapped_id, identity=identity)
-        self._session.add(model)
-        self._session.flush()
+        if self._orm:
+            self._session.add(self._model.create(mapped_id, identity))
+            self._session.flush()
+        else:
+            self._session.execute(
+                self._table.insert(),
+                self._model.values(mapped_id, identity),
+            )
+        self._mark_written()
+        self._remember(mapped_id, identity)
+
+    def add_many(self, rows: Iterable[Tuple[int, Identity]]) -> BulkResult:
+        if self._orm:
+            self._session.flush()
+        inserted = skipped = 0
+        for chunk in chunked(rows, self._chunk_size):
+            values: Dict[Key, Dict[str, Any]] = {}
+            for mapped_id, identity in chunk:
+                row = self._model.values(mapped_id, identity)
+                values.setdefault((row['platform'], row['digest']), row)
+            new = self._insert_new(values)
+            if new:
+                self._mark_written()
+            inserted += new
+            skipped += len(chunk) - new
+        return BulkResult(inserted=inserted, skipped=skipped)
+
+    def get_or_add(self, mapped_id: int, identity: Identity) -> int:
+        return self.get_or_add_many([(mapped_id, identity)])[identity]
+
+    def get_or_add_many(
+            self, rows: Iterable[Tuple[int, Identity]],
+    ) -> Dict[Identity, int]:
+        if self._orm:
+            self._session.flush()
+        result = {}
+        for chunk in chunked(rows, self._chunk_size):
+            values: Dict[Key, Dict[str, Any]] = {}
+            identities: Dict[Identity, Key] = {}
+            for mapped_id, identity in chunk:
+                row = self._model.values(mapped_id, identity)
+                key = identities[identity] = row['platform'], row['digest']
+                values.setdefault(key, row)
+
+            found = self._insert_missing(values)
+            self._mark_written()
+            for identity, key in identities.items():
+                result[identity] = found[key]
+                self._remember(found[key], identity)
+        return result
 
     def get_id(self, identity: Identity) -> Optional[int]:
-        mapping = self._session.query(Mapping).filter_by(
-            identity=identity,
-        ).one_or_none()
-        return mapping and mapping.id
+        if self._cache:
+            mapped_id = self._cache.ids.get(identity)
+            if mapped_id is not None:
+                return mapped_id
+        if self._core_reads:
+            query = select_id(identity, self._model)
+            mapped_id = self._session.execute(query).scalar_one_or_none()
+        else:
+            mapping = self._session.query(self._model).filter_by(
+                identity=identity,
+            ).one_or_none()
+            mapped_id = mapping and mapping.id
+        if mapped_id is not None:
+            self._remember(mapped_id, identity)
+        return mapped_id
+
+    def get_ids(
+            self, identities: Iterable[Identity],
+    ) -> Dict[Identity, Optional[int]]:
+        result: Dict[Identity, Optional[int]] = {}
+        keys = {}
+        for identity in identities:
+            mapped_id = self._cache and self._cache.ids.get(identity)
+            if mapped_id is not None:
+                result[identity] = mapped_id
+            else:
+                platform = self._model.get_platform(identity)
+                keys[identity] = platform, self._model.digest(identity)
+
+        found = self._lookup(keys.values())
+        for identity, key in keys.items():
+            mapped_id = result[identity] = found.get(key)
+            if mapped_id is not None:
+                self._remember(mapped_id, identity)
+        return result
 
     def get_identity(self, mapped_id: int) -> List[Identity]:
-        query = self._session.query(Mapping).filter(
-            Mapping.id == mapped_id,
-        )
-        return [mapping.identity for mapping in query]
+        if self._cache:
+            identities = self._cache.identities.get(mapped_id)
+            if identities is not None:
+                return list(identities)
+        if self._core_reads:
+            query = select_identities(mapped_id, self._model)
+            identities = [
+                self._model.load_row(row)
+                for row in self._session.execute(query)
+            ]
+        else:
+            query = self._session.query(self._model).filter(
+                self._model.id == mapped_id,
+            )
+            identities = [mapping.identity for mapping in query]
+        if identities and self._cache:
+            self._cache.identities.put(mapped_id, list(identities))
+            self._session.info.setdefault(CACHED, []).extend(
+                (self._cache, mapped_id, identity) for identity in identities
+            )
+        return identities
+
+    def _mark_written(self) -> None:
+        if self._cache:
+            self._session.info[WROTE] = True
+
+    def _remember(self, mapped_id: int, identity: Identity) -> None:
+        if self._cache:
+            self._cache.put(mapped_id, identity)
+            self._session.info.setdefault(CACHED, []).append(
+                (self._cache, mapped_id, identity),
+            )
+
+    def _insert_new(self, values: Dict[Key, Dict[str, Any]]) -> int:
+        table = self._table
+        dialect = self._dialect()
+        upsert = UPSERTS.get(dialect.name)
+        if upsert and dialect.insert_returning:
+            query = (
+                upsert(table)
+                .on_conflict_do_nothing(
+                    index_elements=[table.c.platform, table.c.digest],
+                )
+                .returning(table.c.id)
+            )
+            return len(
+                self._session.execute(query, list(values.values())).all(),
+            )
+
+        existing = self._lookup(values)
+        new = [row for key, row in values.items() if key not in existing]
+        if new:
+            self._session.execute(table.insert(), new)
+        return len(new)
+
+    def _insert_missing(
+            self, values: Dict[Key, Dict[str, Any]],
+    ) -> Dict[Key, int]:
+        table = self._table
+        dialect = self._dialect()
+        upsert = UPSERTS.get(dialect.name)
+        if upsert and dialect.insert_returning:
+            query = (
+                upsert(table)
+                .on_conflict_do_nothing(
+                    index_elements=[table.c.platform, table.c.digest],
+                )
+                .returning(table.c.platform, table.c.digest, table.c.id)
+            )
+            rows = self._session.execute(query, list(values.values()))
+            found = {
+                (platform, digest): mapped_id
+                for platform, digest, mapped_id in rows
+            }
+            missing = [key for key in values if key not in found]
+            if missing:
+                found.update(self._lookup(missing))
+            return found
+
+        found = self._lookup(values)
+        for key, row in values.items():
+            if key in found:
+                continue
+            try:
+                with self._session.begin_nested():
+                    self._session.execute(table.insert(), row)
+            except IntegrityError:
+                existing = self._lookup([key])
+                if not existing:
+                    raise
+                found.update(existing)
+            else:
+                found[key] = row['id']
+        return found
+
+    def _dialect(self) -> Dialect:
+        if self._orm:
+            return self._session.get_bind().dialect
+        return self._session.dialect
+
+    def _lookup(self, keys: Iterable[Key]) -> Dict[Key, int]:
+        table = self._table
+        digests: Dict[Platform, List[bytes]] = {}
+        for platform, digest in keys:
+            digests.setdefault(platform, []).append(digest)
+
+        found = {}
+        for platform, platform_digests in digests.items():
+            for chunk in chunked(platform_digests, self._chunk_size):
+                query = sa.select(table.c.id, table.c.digest).where(
+                    table.c.platform == platform,
+                    table.c.digest.in_(chunk),
+                )
+                for mapped_id, digest in self._session.execute(query):
+                    found[platform, digest] = mapped_id
+        return found
@@ -0,0 +1,27 @@
+from typing import List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .acl import Model, select_id, select_identities
+from .model import Mapping
+from .platform import Identity
+
+
+class AsyncAcl:
+    def __init__(self, session: AsyncSession, model: Model = Mapping) -> None:
+        self._session = session
+        self._model = model
+
+    async def add(self, mapped_id: int, identity: Identity) -> None:
+        self._session.add(self._model.create(mapped_id, identity))
+        await self._session.flush()
+
+    async def get_id(self, identity: Identity) -> Optional[int]:
+        query = select_id(identity, self._model)
+        result = await self._session.execute(query)
+        return result.scalar_one_or_none()
+
+    async def get_identity(self, mapped_id: int) -> List[Identity]:
+        query = select_identities(mapped_id, self._model)
+        result = await self._session.execute(query)
+        return [self._model.load_row(row) for row in result]
@@ -0,0 +1,155 @@
+import argparse
+import json
+import platform
+import sys
+from random import sample
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+
+from db import make_engine, make_sessionmaker, metadata
+from .acl import Acl
+from .model import Mapping, TypedMapping
+from .platform import AmazonId, CDiscountId, EbayId, Identity
+
+MODELS = {'json': Mapping, 'typed': TypedMapping}
+SITES = ['GB', 'US', 'PL', 'FR', 'CN', 'DE']
+
+
+# Deterministic, so any stored row can be rebuilt from its index and
+# lookups can sample the whole table without keeping it in memory.
+def identity(index: int) -> Identity:
+    kind = index % 3
+    if kind == 0:
+        return AmazonId(
+            asin=f'B{index:09d}', sku=f'SKU-{index}',
+            site=SITES[index % len(SITES)], merchant_id=f'M{index % 997}',
+        )
+    elif kind == 1:
+        return CDiscountId(sku=f'SKU-{index}', user_id=index)
+    return EbayId(item_id=f'{index:012d}', sku=f'SKU-{index}')
+
+
+def identities(count: int, start: int = 0) -> Iterator[Identity]:
+    for index in range(start, start + count):
+        yield identity(index)
+
+
+def measure(operation: Callable[[Any], Any], args: Iterable) -> Dict:
+    latencies = []
+    for arg in args:
+        start = perf_counter()
+        operation(arg)
+        latencies.append(perf_counter() - start)
+    return summary(latencies)
+
+
+def summary(latencies: List[float]) -> Dict:
+    percentiles = quantiles(latencies, n=100, method='inclusive')
+    return {
+        'operations': len(latencies),
+        'throughput': len(latencies) / sum(latencies),
+        'p50_us': percentiles[49] * 1e6,
+        'p99_us': percentiles[98] * 1e6,
+    }
+
+
+def benchmark(engine: Engine, model: type, size: int, samples: int) -> Dict:
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    session = make_sessionmaker(engine)()
+    acl = Acl(session, model=model)
+
+    start = perf_counter()
+    acl.add_many(enumerate(identities(size)))
+    session.commit()
+    fill_seconds = perf_counter() - start
+
+    new = list(zip(range(size, size + samples), identities(samples, size)))
+    add = measure(lambda row: acl.add(*row), new)
+    session.commit()
+
+    lookups = sample(range(size), min(samples, size))
+    session.expunge_all()
+    get_id = measure(acl.get_id, [identity(index) for index in lookups])
+    session.expunge_all()
+    get_identity = measure(acl.get_identity, lookups)
+
+    session.expunge_all()
+    start = perf_counter()
+    loaded = sum(1 for mapping in session.query(model) if mapping.identity)
+    orm_seconds = perf_counter() - start
+
+    start = perf_counter()
+    query = sa.select(*model.identity_columns())
+    loaded_core = sum(
+        1 for row in session.execute(query) if model.load_row(row)
+    )
+    core_seconds = perf_counter() - start
+    session.close()
+
+    return {
+        'rows': size + samples,
+        'fill_rows_per_second': size / fill_seconds,
+        'add': add,
+        'get_id': get_id,
+        'get_identity': get_identity,
+        'orm_rows_loaded_per_second': loaded / orm_seconds,
+        'core_rows_loaded_per_second': loaded_core / core_seconds,
+    }
+
+
+def digest_cost(samples: int) -> Dict:
+    return measure(Mapping.digest, list(identities(samples)))
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Acl mapping layer.',
+    )
+    parser.add_argument(
+        '--url', help='database to use, a temporary SQLite file by default',
+    )
+    parser.add_argument(
+        '--reset', action='store_true',
+        help='allow dropping and recreating the tables of --url',
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--model', choices=MODELS, default='json')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    if args.url and not args.reset:
+        parser.error('--url needs --reset, its mapping tables are dropped')
+
+    with TemporaryDirectory() as directory:
+        engine = make_engine(args.url or f'sqlite:///{directory}/bench.db')
+        results = {
+            'python': platform.python_version(),
+            'sqlalchemy': sa.__version__,
+            'url': engine.url.render_as_string(hide_password=True),
+            'model': args.model,
+            'digest': digest_cost(args.samples),
+            'sizes': {
+                str(size): benchmark(
+                    engine, MODELS[args.model], size, args.samples,
+                )
+                for size in args.sizes
+            },
+        }
+        metadata.drop_all(engine)
+        engine.dispose()
+    json.dump(results, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
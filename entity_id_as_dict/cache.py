@@ -0,0 +1,39 @@
+from typing import Callable, List, Optional
+
+from cache import CacheStats, LRUCache
+from .platform import Identity
+
+
+class IdentityCache:
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: Optional[float] = None,
+            clock: Optional[Callable[[], float]] = None,
+    ) -> None:
+        options = {'clock': clock} if clock else {}
+        self.ids: LRUCache[Identity, int] = LRUCache(maxsize, ttl, **options)
+        self.identities: LRUCache[int, List[Identity]] = LRUCache(
+            maxsize, ttl, **options,
+        )
+
+    @property
+    def stats(self) -> CacheStats:
+        ids, identities = self.ids.stats, self.identities.stats
+        return CacheStats(
+            hits=ids.hits + identities.hits,
+            misses=ids.misses + identities.misses,
+            evictions=ids.evictions + identities.evictions,
+        )
+
+    def put(self, mapped_id: int, identity: Identity) -> None:
+        self.ids.put(identity, mapped_id)
+        self.identities.put(mapped_id, [identity])
+
+    def invalidate(self, mapped_id: int, identity: Identity) -> None:
+        self.ids.invalidate(identity)
+        self.identities.invalidate(mapped_id)
+
+    def clear(self) -> None:
+        self.ids.clear()
+        self.identities.clear()
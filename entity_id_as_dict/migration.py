@@ -0,0 +1,82 @@
+from typing import Iterator, List, Optional, Union
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection, Engine, Row
+from sqlalchemy.orm import Session
+
+from .model import Mapping, TypedMapping, table, typed_table
+
+
+def check_digests(
+        connection: Union[Connection, Session], batch_size: int = 1000,
+) -> Iterator[int]:
+    for rows in _batches(connection, batch_size):
+        for row in rows:
+            if Mapping.digest(Mapping.load_row(row)) != row.digest:
+                yield row.id
+
+
+# A move, not a copy: every batch is inserted into typed_mappings and
+# deleted from mappings in its own transaction, so a row is never readable
+# from both tables and an interrupted run resumes where it stopped. A row
+# whose id is already typed is only deleted when both identities match;
+# conflicting rows stay in mappings for inspection.
+def migrate_to_typed(engine: Engine, batch_size: int = 1000) -> int:
+    migrated = 0
+    last_id = None
+    while True:
+        with engine.begin() as connection:
+            rows = _batch(connection, batch_size, last_id)
+            if not rows:
+                return migrated
+            ids = [row.id for row in rows]
+            typed = {
+                row.id: TypedMapping.load_row(row)
+                for row in connection.execute(
+                    sa.select(
+                        typed_table.c.id, *TypedMapping.identity_columns(),
+                    ).where(typed_table.c.id.in_(ids)),
+                )
+            }
+            values, moved = [], []
+            for row in rows:
+                identity = Mapping.load_row(row)
+                if row.id not in typed:
+                    values.append(TypedMapping.values(row.id, identity))
+                elif typed[row.id] != identity:
+                    continue
+                moved.append(row.id)
+            if values:
+                connection.execute(typed_table.insert(), values)
+            connection.execute(table.delete().where(table.c.id.in_(moved)))
+            migrated += len(values)
+        if len(rows) < batch_size:
+            return migrated
+        last_id = rows[-1].id
+
+
+def _batches(
+        connection: Union[Connection, Session], batch_size: int,
+) -> Iterator[List[Row]]:
+    last_id = None
+    while True:
+        rows = _batch(connection, batch_size, last_id)
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1].id
+
+
+def _batch(
+        connection: Union[Connection, Session], batch_size: int,
+        last_id: Optional[int],
+) -> List[Row]:
+    query = (
+        sa.select(table.c.id, table.c.digest, *Mapping.identity_columns())
+        .order_by(table.c.id)
+        .limit(batch_size)
+    )
+    if last_id is not None:
+        query = query.where(table.c.id > last_id)
+    return connection.execute(query).all()
@@ -1,26 +1,54 @@
 from __future__ import annotations
 
 import hashlib
-import json
-from enum import Enum
+from dataclasses import fields
+from typing import Any, Callable, Dict, Tuple, Type
 
 import sqlalchemy as sa
+from sqlalchemy.engine import Row
 from sqlalchemy.ext.hybrid import Comparator, hybrid_property
 
 from db import Base
-from .platform import AmazonId, CDiscountId, EbayId, Identity
+from .platform import (
+    Identity,
+    Platform,
+    canonical_json,
+    get_platform,
+    load,
+    registered,
+)
 
+COLUMN_TYPES: Dict[type, Callable[[], sa.types.TypeEngine]] = {
+    str: lambda: sa.String(255),
+    int: sa.BigInteger,
+}
 
-class Mapping(Base):
+
+class IdentityMixin:
+    @classmethod
+    def get_platform(cls, identity: Identity) -> Platform:
+        return get_platform(identity)
+
+    @classmethod
+    def digest(cls, identity: Identity) -> bytes:
+        digest = vars(identity).get('_digest')
+        if digest is None:
+            digest = hashlib.md5(canonical_json(identity)).digest()
+            object.__setattr__(identity, '_digest', digest)
+        return digest
+
+    @classmethod
+    def load(cls, platform: Platform, data: Dict[str, Any]) -> Identity:
+        return load(platform, data)
+
+
+class Mapping(IdentityMixin, Base):
     __tablename__ = 'mappings'
     __table_args__ = (
         sa.UniqueConstraint('platform', 'digest', name='platform_identity'),
     )
 
-    class Platform(Enum):
-        AMAZON = 'Amazon'
-        EBAY = 'eBay'
-        CDISCOUNT = 'CDiscount'
+    Platform = Platform
 
     id = sa.Column(sa.BigInteger, primary_key=True)
     _platform = sa.Column('platform', sa.Enum(Platform), nullable=False)
@@ -28,32 +56,29 @@ class Mapping(Base):
     _digest = sa.Column('digest', sa.VARBINARY(16), nullable=False)
 
     @classmethod
-    def get_platform(cls, identity: Identity) -> Platform:
-        if isinstance(identity, AmazonId):
-            return Mapping.Platform.AMAZON
-        elif isinstance(identity, CDiscountId):
-            return Mapping.Platform.CDISCOUNT
-        elif isinstance(identity, EbayId):
-            return Mapping.Platform.EBAY
-        raise NotImplementedError(identity)
+    def create(cls, mapped_id: int, identity: Identity) -> Mapping:
+        return cls(id=mapped_id, identity=identity)
 
     @classmethod
-    def digest(cls, identity: Identity) -> bytes:
-        identity_json = json.dumps(
-            identity.asdict(), sort_keys=True,
-        ).encode("utf-8")
-        return hashlib.md5(identity_json).digest()
+    def values(cls, mapped_id: int, identity: Identity) -> Dict[str, Any]:
+        return {
+            'id': mapped_id,
+            'platform': cls.get_platform(identity),
+            'identity': identity.asdict(),
+            'digest': cls.digest(identity),
+        }
+
+    @classmethod
+    def identity_columns(cls) -> Tuple[sa.Column, ...]:
+        return cls.__table__.c.platform, cls.__table__.c.identity
+
+    @classmethod
+    def load_row(cls, row: Row) -> Identity:
+        return load(row.platform, row.identity)
 
     @hybrid_property
     def identity(self) -> Identity:
-        if self._platform == Mapping.Platform.AMAZON:
-            return AmazonId(**self._dict)
-        elif self._platform == Mapping.Platform.CDISCOUNT:
-            return CDiscountId(**self._dict)
-        elif self._platform == Mapping.Platform.EBAY:
-            return EbayId(**self._dict)
-        else:
-            raise NotImplementedError(self._platform)
+        return self.load(self._platform, self._dict)
 
     @identity.setter
     def identity(self, value: Identity) -> None:
@@ -62,10 +87,115 @@ class Mapping(Base):
         self._digest = self.digest(value)
 
     @identity.comparator
-    def identity(self) -> Mapping.IdentityComparator:
-        return Mapping.IdentityComparator(self._digest)
+    def identity(cls) -> Mapping.IdentityComparator:
+        return Mapping.IdentityComparator(cls._platform, cls._digest)
 
     class IdentityComparator(Comparator):
+        def __init__(self, platform: sa.Column, digest: sa.Column) -> None:
+            super().__init__(digest)
+            self.platform = platform
+
         def __eq__(self, other: Identity) -> bool:
             other_digest = Mapping.digest(other)
-            return self.__clause_element__() == other_digest
+            return sa.and_(
+                self.platform == Mapping.get_platform(other),
+                self.__clause_element__() == other_digest,
+            )
+
+
+def typed_columns() -> Dict[str, sa.Column]:
+    types: Dict[str, type] = {}
+    indexed: Dict[str, bool] = {}
+    for cls in registered().values():
+        for field in fields(cls):
+            if types.setdefault(field.name, field.type) is not field.type:
+                raise TypeError(
+                    f'{cls.__name__}.{field.name} conflicts with the '
+                    f'{types[field.name].__name__} column of the same name.'
+                )
+            index = field.metadata.get('index', False)
+            indexed[field.name] = indexed.get(field.name, False) or index
+    return {
+        name: sa.Column(name, COLUMN_TYPES[type_](), index=indexed[name])
+        for name, type_ in types.items()
+    }
+
+
+class TypedMapping(IdentityMixin, Base):
+    __tablename__ = 'typed_mappings'
+    __table_args__ = (
+        sa.UniqueConstraint(
+            'platform', 'digest', name='typed_platform_identity',
+        ),
+    )
+
+    id = sa.Column(sa.BigInteger, primary_key=True)
+    _platform = sa.Column('platform', sa.Enum(Platform), nullable=False)
+    _digest = sa.Column('digest', sa.VARBINARY(16), nullable=False)
+
+    __mapper_args__ = {'polymorphic_on': _platform}
+
+    @classmethod
+    def create(cls, mapped_id: int, identity: Identity) -> TypedMapping:
+        mapper = cls.__mapper__.polymorphic_map[get_platform(identity)]
+        return mapper.class_(id=mapped_id, identity=identity)
+
+    @classmethod
+    def values(cls, mapped_id: int, identity: Identity) -> Dict[str, Any]:
+        return {
+            'id': mapped_id,
+            'platform': cls.get_platform(identity),
+            'digest': cls.digest(identity),
+            **dict.fromkeys(IDENTITY_FIELDS),
+            **identity.asdict(),
+        }
+
+    @classmethod
+    def identity_columns(cls) -> Tuple[sa.Column, ...]:
+        columns = cls.__table__.c
+        return (columns.platform, *(columns[name] for name in IDENTITY_FIELDS))
+
+    @classmethod
+    def load_row(cls, row: Row) -> Identity:
+        return load(row.platform, row._mapping)
+
+    @hybrid_property
+    def identity(self) -> Identity:
+        fields = {name: getattr(self, name) for name in IDENTITY_FIELDS}
+        return self.load(self._platform, fields)
+
+    @identity.setter
+    def identity(self, value: Identity) -> None:
+        self._platform = self.get_platform(value)
+        for name, field_value in value.asdict().items():
+            setattr(self, name, field_value)
+        self._digest = self.digest(value)
+
+    @identity.comparator
+    def identity(cls) -> Mapping.IdentityComparator:
+        return Mapping.IdentityComparator(cls._platform, cls._digest)
+
+
+# Columns and per-platform subclasses come from the platform registry, so
+# registering a new identity type (before this module is imported) is
+# enough to store it in typed_mappings.
+_typed_columns = typed_columns()
+for _name, _column in _typed_columns.items():
+    setattr(TypedMapping, _name, _column)
+IDENTITY_FIELDS = tuple(_typed_columns)
+
+TYPED_MAPPINGS: Dict[Platform, Type[TypedMapping]] = {
+    platform: type(
+        cls.__name__.removesuffix('Id') + 'Mapping',
+        (TypedMapping,),
+        {'__mapper_args__': {'polymorphic_identity': platform}},
+    )
+    for platform, cls in registered().items()
+}
+AmazonMapping = TYPED_MAPPINGS[Platform.AMAZON]
+CDiscountMapping = TYPED_MAPPINGS[Platform.CDISCOUNT]
+EbayMapping = TYPED_MAPPINGS[Platform.EBAY]
+
+
+table = Mapping.__table__
+typed_table = TypedMapping.__table__
@@ -1,16 +1,65 @@
-from dataclasses import dataclass, asdict
-from typing import Text, Union
+import json
+from dataclasses import dataclass, asdict, field, fields
+from enum import Enum
+from json.encoder import encode_basestring_ascii
+from typing import Any, Callable, Dict, Text, Tuple, Type, TypeVar, Union
 
+T = TypeVar('T')
 
+
+class Platform(Enum):
+    AMAZON = 'Amazon'
+    EBAY = 'eBay'
+    CDISCOUNT = 'CDiscount'
+
+
+_platforms: Dict[type, Platform] = {}
+_constructors: Dict[Platform, Callable[[Dict[Text, Any]], Any]] = {}
+_field_keys: Dict[type, Tuple[Tuple[Text, Text], ...]] = {}
+
+
+def register(platform: Platform) -> Callable[[Type[T]], Type[T]]:
+    def decorator(cls: Type[T]) -> Type[T]:
+        names = tuple(field.name for field in fields(cls))
+        _platforms[cls] = platform
+        _constructors[platform] = _compile_constructor(cls, names)
+        _field_keys[cls] = tuple(
+            (name, encode_basestring_ascii(name) + ': ')
+            for name in sorted(names)
+        )
+        return cls
+    return decorator
+
+
+# Generated once per type, the same way dataclasses builds __init__. Rows
+# are loaded straight into the frozen instance's __dict__, skipping
+# keyword unpacking and the object.__setattr__ calls of a frozen __init__.
+def _compile_constructor(
+        cls: type, names: Tuple[Text, ...],
+) -> Callable[[Dict[Text, Any]], Any]:
+    lines = [
+        'def construct(data):',
+        '    identity = new(cls)',
+        '    fields = identity.__dict__',
+        *(f'    fields[{name!r}] = data[{name!r}]' for name in names),
+        '    return identity',
+    ]
+    namespace = {'cls': cls, 'new': object.__new__}
+    exec('\n'.join(lines), namespace)
+    return namespace['construct']
+
+
+@register(Platform.AMAZON)
 @dataclass(frozen=True)
 class AmazonId:
     asin: Text
     sku: Text
-    site: Text
-    merchant_id: Text
+    site: Text = field(metadata={'index': True})
+    merchant_id: Text = field(metadata={'index': True})
     asdict = asdict
 
 
+@register(Platform.CDISCOUNT)
 @dataclass(frozen=True)
 class CDiscountId:
     sku: Text
@@ -18,6 +67,7 @@ class CDiscountId:
     asdict = asdict
 
 
+@register(Platform.EBAY)
 @dataclass(frozen=True)
 class EbayId:
     item_id: Text
@@ -26,3 +76,43 @@ class EbayId:
 
 
 Identity = Union[AmazonId, CDiscountId, EbayId]
+
+
+def registered() -> Dict[Platform, type]:
+    return {platform: cls for cls, platform in _platforms.items()}
+
+
+def get_platform(identity: Identity) -> Platform:
+    try:
+        return _platforms[type(identity)]
+    except KeyError:
+        raise NotImplementedError(identity)
+
+
+def load(platform: Platform, data: Dict[Text, Any]) -> Identity:
+    try:
+        constructor = _constructors[platform]
+    except KeyError:
+        raise NotImplementedError(platform)
+    return constructor(data)
+
+
+# Byte-compatible with json.dumps(identity.asdict(), sort_keys=True) which
+# was used to compute digests already stored in the mappings table.
+def canonical_json(identity: Identity) -> bytes:
+    try:
+        keys = _field_keys[type(identity)]
+    except KeyError:
+        raise NotImplementedError(identity)
+    encoded = ', '.join(
+        key + _encode(getattr(identity, name)) for name, key in keys
+    )
+    return ('{' + encoded + '}').encode('ascii')
+
+
+def _encode(value: Any) -> Text:
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    elif type(value) is int:
+        return int.__repr__(value)
+    return json.dumps(value, sort_keys=True)
@@ -1,13 +1,37 @@
-from typing import Tuple, Iterator
-from unittest import TestCase
+import asyncio
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from tempfile import TemporaryDirectory
+from typing import Iterator, Optional, Tuple
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
 
 from factory import Factory, Iterator as IteratorFactory
 from factory.fuzzy import FuzzyInteger, FuzzyText
+from sqlalchemy import BigInteger
+from sqlalchemy.event import listen, remove
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
-from db import memory_engine, metadata
-from .acl import Acl
-from .platform import AmazonId, CDiscountId, EbayId, Identity
+from db import make_engine, make_scoped_session, memory_engine, metadata
+from cache import CacheStats
+from . import acl as acl_module
+from .acl import Acl, BulkResult
+from .async_acl import AsyncAcl
+from .cache import IdentityCache
+from .migration import check_digests, migrate_to_typed
+from .model import (
+    AmazonMapping,
+    Mapping,
+    TYPED_MAPPINGS,
+    TypedMapping,
+    table,
+    typed_table,
+)
+from .platform import AmazonId, CDiscountId, EbayId, Identity, registered
 
 
 class AmazonIdFactory(Factory):
@@ -54,6 +78,203 @@ class TestAcl(TestCase):
             found, = self.acl.get_identity(mapped_id)
             self.assertEqual(found, identity)
 
+    def test_core_reads_skip_identity_map(self):
+        stored = dict(self.identities())
+        self.session.expunge_all()
+        acl = Acl(self.session, core_reads=True)
+
+        for mapped_id, identity in stored.items():
+            self.assertEqual(acl.get_id(identity), mapped_id)
+            self.assertEqual(acl.get_identity(mapped_id), [identity])
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_acl_on_bare_connection(self):
+        with memory_engine.begin() as connection:
+            acl = Acl(connection)
+            identity = AmazonIdFactory()
+            acl.add(1, identity)
+            acl.add_many([(2, CDiscountIdFactory()), (3, identity)])
+
+            self.assertEqual(acl.get_id(identity), 1)
+            self.assertEqual(acl.get_identity(1), [identity])
+            self.assertIsNone(acl.get_id(EbayIdFactory()))
+
+    def test_get_or_add_returns_existing_id(self):
+        stored = AmazonIdFactory()
+        self.acl.add(1, stored)
+
+        self.assertEqual(self.acl.get_or_add(2, stored), 1)
+        self.assertEqual(self.acl.get_or_add(3, EbayIdFactory()), 3)
+        self.assertEqual(self.acl.get_identity(2), [])
+
+    def test_get_or_add_many_resolves_batch(self):
+        stored, new = CDiscountIdFactory(), EbayIdFactory()
+        self.acl.add(1, stored)
+
+        found = self.acl.get_or_add_many([(2, stored), (3, new), (4, new)])
+
+        self.assertEqual(found, {stored: 1, new: 3})
+        self.assertEqual(self.acl.get_identity(3), [new])
+
+    def test_get_or_add_falls_back_to_savepoint(self):
+        stored, new = AmazonIdFactory(), CDiscountIdFactory()
+        self.acl.add(1, stored)
+
+        with patch.dict(acl_module.UPSERTS, clear=True):
+            found = self.acl.get_or_add_many([(2, stored), (3, new)])
+
+        self.assertEqual(found, {stored: 1, new: 3})
+
+    def test_get_or_add_reraises_conflicting_mapped_id(self):
+        self.acl.add(1, AmazonIdFactory())
+
+        with self.assertRaises(IntegrityError):
+            self.acl.get_or_add(1, EbayIdFactory())
+
+    def test_add_many_identities(self):
+        rows = [(i, AmazonIdFactory()) for i in range(1200)]
+
+        result = self.acl.add_many(iter(rows))
+
+        self.assertEqual(result, BulkResult(inserted=1200, skipped=0))
+        for mapped_id, identity in rows[::100]:
+            self.assertEqual(self.acl.get_id(identity), mapped_id)
+
+    def test_add_many_skips_duplicated_identities(self):
+        stored = CDiscountIdFactory()
+        self.acl.add(0, stored)
+        new = EbayIdFactory()
+        rows = [(1, stored), (2, new), (3, new)]
+
+        result = self.acl.add_many(rows)
+
+        self.assertEqual(result, BulkResult(inserted=1, skipped=2))
+        self.assertEqual(self.acl.get_id(stored), 0)
+        self.assertEqual(self.acl.get_id(new), 2)
+
+    def test_find_many_ids_by_identities(self):
+        stored = dict(self.identities())
+        missing = AmazonIdFactory()
+
+        found = self.acl.get_ids([*stored.values(), missing])
+
+        expected = {identity: i for i, identity in stored.items()}
+        self.assertEqual(found, {**expected, missing: None})
+
+    def test_cached_lookups_skip_database(self):
+        cache = IdentityCache(maxsize=10)
+        acl = Acl(self.session, cache=cache)
+        identity = AmazonIdFactory()
+        acl.add(1, identity)
+        self.session.query(Mapping).delete()
+
+        self.assertEqual(acl.get_id(identity), 1)
+        self.assertEqual(acl.get_ids([identity]), {identity: 1})
+        self.assertEqual(acl.get_identity(1), [identity])
+        self.assertEqual(
+            cache.stats, CacheStats(hits=3, misses=0, evictions=0),
+        )
+
+    def test_cache_fills_on_miss(self):
+        identity = EbayIdFactory()
+        self.acl.add(1, identity)
+        cache = IdentityCache(maxsize=10)
+        acl = Acl(self.session, cache=cache)
+
+        self.assertEqual(acl.get_id(identity), 1)
+        self.assertEqual(acl.get_id(identity), 1)
+        self.assertEqual(acl.get_identity(1), [identity])
+        self.assertEqual(acl.get_identity(1), [identity])
+        self.assertEqual(
+            cache.stats, CacheStats(hits=3, misses=1, evictions=0),
+        )
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = IdentityCache(maxsize=2)
+        acl = Acl(self.session, cache=cache)
+        first, second, third = (CDiscountIdFactory() for _ in range(3))
+        acl.add(1, first)
+        acl.add(2, second)
+        acl.get_id(first)
+        acl.add(3, third)
+
+        self.assertIsNone(cache.ids.get(second))
+        self.assertEqual(cache.ids.get(first), 1)
+        self.assertEqual(cache.stats.evictions, 2)
+
+    def test_cache_expires_entries(self):
+        now = [0.0]
+        cache = IdentityCache(maxsize=10, ttl=60, clock=lambda: now[0])
+        acl = Acl(self.session, cache=cache)
+        identity = AmazonIdFactory()
+        acl.add(1, identity)
+
+        now[0] = 61
+        self.assertIsNone(cache.ids.get(identity))
+        self.assertEqual(acl.get_id(identity), 1)
+
+    def test_cache_dropped_on_rollback(self):
+        cache = IdentityCache(maxsize=10)
+        acl = Acl(self.session, cache=cache)
+        kept, dropped = AmazonIdFactory(), EbayIdFactory()
+        acl.add(1, kept)
+        self.session.commit()
+
+        acl.get_or_add(2, dropped)
+        self.session.rollback()
+
+        self.assertEqual(acl.get_id(kept), 1)
+        self.assertIsNone(cache.ids.get(dropped))
+        self.assertIsNone(acl.get_id(dropped))
+
+    def test_digest_compatible_with_json_dumps(self):
+        identities = [
+            AmazonIdFactory(),
+            CDiscountIdFactory(),
+            EbayIdFactory(),
+            EbayId(item_id='zażółć "gęślą"\\', sku='\u2603\n'),
+        ]
+        for identity in identities:
+            with self.subTest(identity):
+                self.assertEqual(
+                    Mapping.digest(identity), legacy_digest(identity),
+                )
+
+    def test_stored_digests_match(self):
+        rows = [
+            Mapping.values(i, identity)
+            for i, identity in enumerate(
+                [AmazonIdFactory(), CDiscountIdFactory(), EbayIdFactory()]
+            )
+        ]
+        for row in rows:
+            row['digest'] = legacy_digest(Mapping.load(
+                row['platform'], row['identity'],
+            ))
+        rows[1]['digest'] = b'\x00' * 16
+        self.session.execute(table.insert(), rows)
+
+        mismatched = list(check_digests(self.session, batch_size=2))
+
+        self.assertEqual(mismatched, [1])
+
+    def test_load_identity_for_each_platform(self):
+        for identity in [
+            AmazonIdFactory(), CDiscountIdFactory(), EbayIdFactory(),
+        ]:
+            with self.subTest(identity):
+                platform = Mapping.get_platform(identity)
+                loaded = Mapping.load(platform, identity.asdict())
+                self.assertEqual(loaded, identity)
+
+    def test_unregistered_identity_is_rejected(self):
+        @dataclass(frozen=True)
+        class UnknownId:
+            sku: str
+
+        with self.assertRaises(NotImplementedError):
+            Mapping.get_platform(UnknownId('sku'))
+
     def identities(self) -> Iterator[Tuple[int, Identity]]:
         identities = {
             'Amazon': AmazonIdFactory(),
@@ -65,3 +286,216 @@ class TestAcl(TestCase):
             with self.subTest(platform):
                 self.acl.add(i, identity)
                 yield i, identity
+
+
+class TestTypedAcl(TestCase):
+    def setUp(self) -> None:
+        metadata.create_all(memory_engine)
+        self.session = sessionmaker(bind=memory_engine)()
+        self.acl = Acl(self.session, model=TypedMapping)
+
+    def tearDown(self) -> None:
+        metadata.drop_all(memory_engine)
+
+    def test_find_by_identity_and_id(self):
+        identities = [AmazonIdFactory(), CDiscountIdFactory(), EbayIdFactory()]
+        for mapped_id, identity in enumerate(identities):
+            self.acl.add(mapped_id, identity)
+        self.session.expire_all()
+        core_acl = Acl(self.session, model=TypedMapping, core_reads=True)
+
+        for acl in [self.acl, core_acl]:
+            for mapped_id, identity in enumerate(identities):
+                self.assertEqual(acl.get_id(identity), mapped_id)
+                self.assertEqual(acl.get_identity(mapped_id), [identity])
+
+    def test_bulk_operations(self):
+        first, second = CDiscountIdFactory(), AmazonIdFactory()
+
+        result = self.acl.add_many([(1, first), (2, EbayIdFactory())])
+        found = self.acl.get_or_add_many([(3, first), (4, second)])
+
+        self.assertEqual(result, BulkResult(inserted=2, skipped=0))
+        self.assertEqual(found, {first: 1, second: 4})
+
+    def test_filter_by_identity_field(self):
+        gb = AmazonIdFactory(site='GB')
+        self.acl.add(1, gb)
+        self.acl.add(2, AmazonIdFactory(site='US'))
+        self.acl.add(3, EbayIdFactory())
+
+        query = self.session.query(AmazonMapping).filter_by(site='GB')
+
+        self.assertEqual([mapping.identity for mapping in query], [gb])
+
+    def test_migrate_json_rows(self):
+        identities = [AmazonIdFactory(), CDiscountIdFactory(), EbayIdFactory()]
+        json_acl = Acl(self.session)
+        for mapped_id, identity in enumerate(identities):
+            json_acl.add(mapped_id, identity)
+        self.acl.add(0, identities[0])
+        self.session.commit()
+
+        migrated = migrate_to_typed(memory_engine, batch_size=2)
+
+        self.assertEqual(migrated, 2)
+        self.assertEqual(self.session.query(Mapping).count(), 0)
+        for mapped_id, identity in enumerate(identities):
+            self.assertEqual(self.acl.get_id(identity), mapped_id)
+            self.assertIsNone(json_acl.get_id(identity))
+
+    def test_migration_keeps_rows_conflicting_with_typed_ones(self):
+        json_identity, typed_identity = AmazonIdFactory(), EbayIdFactory()
+        Acl(self.session).add(0, json_identity)
+        self.acl.add(0, typed_identity)
+        self.session.commit()
+
+        migrated = migrate_to_typed(memory_engine)
+
+        self.assertEqual(migrated, 0)
+        self.assertEqual(Acl(self.session).get_id(json_identity), 0)
+        self.assertEqual(self.acl.get_identity(0), [typed_identity])
+
+    def test_migration_commits_every_batch(self):
+        identities = [AmazonIdFactory(), CDiscountIdFactory(), EbayIdFactory()]
+        json_acl = Acl(self.session)
+        for mapped_id, identity in enumerate(identities):
+            json_acl.add(mapped_id, identity)
+        self.session.commit()
+        batches = []
+
+        def fail_second_batch(conn, clauseelement, *args) -> None:
+            if getattr(clauseelement, 'table', None) is typed_table:
+                batches.append(clauseelement)
+                if len(batches) == 2:
+                    raise RuntimeError('interrupted')
+
+        listen(memory_engine, 'before_execute', fail_second_batch)
+        try:
+            with self.assertRaises(RuntimeError):
+                migrate_to_typed(memory_engine, batch_size=2)
+        finally:
+            remove(memory_engine, 'before_execute', fail_second_batch)
+
+        self.assertEqual(self.session.query(Mapping).count(), 1)
+        self.assertEqual(migrate_to_typed(memory_engine, batch_size=2), 1)
+        for mapped_id, identity in enumerate(identities):
+            self.assertEqual(self.acl.get_id(identity), mapped_id)
+
+    def test_typed_columns_follow_platform_registry(self):
+        columns = typed_table.c
+        for platform, cls in registered().items():
+            mapping = TYPED_MAPPINGS[platform]
+            self.assertEqual(
+                mapping.__mapper__.polymorphic_identity, platform,
+            )
+            for field in fields(cls):
+                self.assertIn(field.name, columns)
+        self.assertTrue(columns.site.index)
+        self.assertIsInstance(columns.user_id.type, BigInteger)
+
+
+class TestAsyncAcl(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.directory = TemporaryDirectory()
+        self.engine = create_async_engine(
+            f'sqlite+aiosqlite:///{self.directory.name}/acl.db',
+        )
+        async with self.engine.begin() as connection:
+            await connection.run_sync(metadata.create_all)
+        self.sessionmaker = async_sessionmaker(self.engine)
+
+    async def asyncTearDown(self) -> None:
+        await self.engine.dispose()
+        self.directory.cleanup()
+
+    async def test_add_and_find(self):
+        identities = [AmazonIdFactory(), CDiscountIdFactory(), EbayIdFactory()]
+        async with self.sessionmaker.begin() as session:
+            acl = AsyncAcl(session)
+            for mapped_id, identity in enumerate(identities):
+                await acl.add(mapped_id, identity)
+
+        async with self.sessionmaker() as session:
+            acl = AsyncAcl(session)
+            for mapped_id, identity in enumerate(identities):
+                self.assertEqual(await acl.get_id(identity), mapped_id)
+                self.assertEqual(
+                    await acl.get_identity(mapped_id), [identity],
+                )
+            self.assertIsNone(await acl.get_id(AmazonIdFactory()))
+
+    async def test_concurrent_lookups_share_pool(self):
+        identities = [EbayIdFactory() for _ in range(50)]
+        async with self.sessionmaker.begin() as session:
+            acl = AsyncAcl(session)
+            for mapped_id, identity in enumerate(identities):
+                await acl.add(mapped_id, identity)
+
+        async def get_id(identity: Identity) -> Optional[int]:
+            async with self.sessionmaker() as session:
+                return await AsyncAcl(session).get_id(identity)
+
+        found = await asyncio.gather(*map(get_id, identities))
+
+        self.assertEqual(found, list(range(50)))
+
+
+class TestScopedAcl(TestCase):
+    def setUp(self) -> None:
+        self.directory = TemporaryDirectory()
+        self.engine = make_engine(f'sqlite:///{self.directory.name}/acl.db')
+        metadata.create_all(self.engine)
+        self.session = make_scoped_session(self.engine)
+
+    def tearDown(self) -> None:
+        self.session.remove()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_threads_use_own_sessions(self):
+        identities = [EbayIdFactory() for _ in range(50)]
+        acl = Acl(self.session)
+        acl.add_many(enumerate(identities))
+        self.session.commit()
+
+        def get_id(identity: Identity) -> Tuple[Optional[int], int]:
+            try:
+                return acl.get_id(identity), id(self.session())
+            finally:
+                self.session.remove()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            found, sessions = zip(*executor.map(get_id, identities))
+
+        self.assertEqual(list(found), list(range(50)))
+        self.assertNotIn(id(self.session()), sessions)
+
+    def test_add_many_skips_rows_added_concurrently(self):
+        raced, new = EbayIdFactory(), AmazonIdFactory()
+        other = make_engine(self.engine.url)
+        added = []
+
+        def add_raced(conn, cursor, statement, *args) -> None:
+            if statement.startswith('INSERT') and not added:
+                with other.begin() as connection:
+                    added.append(Acl(connection).add(5, raced))
+
+        listen(self.engine, 'before_cursor_execute', add_raced)
+        try:
+            result = Acl(self.session).add_many([(1, raced), (2, new)])
+            self.session.commit()
+        finally:
+            remove(self.engine, 'before_cursor_execute', add_raced)
+            other.dispose()
+
+        self.assertEqual(result, BulkResult(inserted=1, skipped=1))
+        self.assertEqual(Acl(self.session).get_id(raced), 5)
+        self.assertEqual(Acl(self.session).get_id(new), 2)
+
+
+def legacy_digest(identity: Identity) -> bytes:
+    identity_json = json.dumps(
+        identity.asdict(), sort_keys=True,
+    ).encode("utf-8")
+    return hashlib.md5(identity_json).digest()
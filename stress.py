@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import platform
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from decimal import Decimal
+from multiprocessing.util import Finalize
+from random import random, sample
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple, Type
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import scoped_session
+
+from db import make_engine, make_scoped_session, metadata
+from entity_id_as_dict.acl import Acl
+from entity_id_as_dict.benchmark import identities
+from entity_id_as_dict.platform import Identity
+from value_object.same_table_immutable.entity import Currency, Money
+from value_object.same_table_immutable.model import Repository
+
+EXECUTORS: Dict[str, Type[Executor]] = {
+    'threads': ThreadPoolExecutor,
+    'processes': ProcessPoolExecutor,
+}
+
+Operation = Tuple[Identity, str, bool]
+
+_engine: Optional[Engine] = None
+_session: Optional[scoped_session] = None
+
+
+def init_worker(url: str) -> None:
+    global _engine, _session
+    _engine = make_engine(url)
+    _session = make_scoped_session(_engine)
+    # Pool processes exit through multiprocessing's hooks, which skip atexit.
+    Finalize(None, _engine.dispose, exitpriority=0)
+
+
+def close_worker() -> None:
+    global _engine, _session
+    if _session is not None:
+        _session.remove()
+    if _engine is not None:
+        _engine.dispose()
+    _engine = _session = None
+
+
+def warm_up(_: int) -> int:
+    return os.getpid()
+
+
+def work(operations: List[Operation]) -> Tuple[int, int]:
+    acl = Acl(_session)
+    repository = Repository(_session)
+    conflicts = 0
+    for identity, name, write in operations:
+        try:
+            acl.get_id(identity)
+            subscription = repository.find(name, for_update=write)
+            if write:
+                fee = subscription.fee
+                subscription.fee = Money(fee.amount + 1, fee.currency)
+                repository.save(subscription)
+        except OperationalError:
+            _session.rollback()
+            conflicts += 1
+        finally:
+            _session.remove()
+    return len(operations), conflicts
+
+
+def fill(url: str, rows: int) -> Tuple[List[Identity], List[str]]:
+    engine = make_engine(url)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    session = make_scoped_session(engine)
+    stored = list(identities(rows))
+    Acl(session).add_many(enumerate(stored))
+    repository = Repository(session)
+    names = [f'plan-{index}' for index in range(rows)]
+    fee = Money(Decimal('10.00'), Currency('EUR'))
+    repository.save_many(repository.create(name, fee) for name in names)
+    session.remove()
+    engine.dispose()
+    return stored, names
+
+
+def plan(
+        stored: List[Identity], names: List[str], count: int,
+        write_ratio: float,
+) -> List[Operation]:
+    return [
+        (identity, name, random() < write_ratio)
+        for identity, name in zip(
+            sample(stored, count), sample(names, count),
+        )
+    ]
+
+
+def run(
+        executor_class: Type[Executor], url: str, workers: int,
+        operations: List[Operation],
+) -> Dict:
+    chunks = [operations[index::workers] for index in range(workers)]
+    if executor_class is ThreadPoolExecutor:
+        init_worker(url)
+        executor = executor_class(max_workers=workers)
+    else:
+        executor = executor_class(
+            max_workers=workers, initializer=init_worker, initargs=(url,),
+        )
+    try:
+        with executor:
+            list(executor.map(warm_up, range(workers)))
+            start = perf_counter()
+            results = list(executor.map(work, chunks))
+            seconds = perf_counter() - start
+    finally:
+        if executor_class is ThreadPoolExecutor:
+            close_worker()
+    done = sum(count for count, _ in results)
+    return {
+        'operations': done,
+        'conflicts': sum(conflicts for _, conflicts in results),
+        'seconds': seconds,
+        'throughput': done / seconds,
+    }
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description='Stress Acl and Repository from concurrent workers.',
+    )
+    parser.add_argument('--path', help='SQLite file, temporary by default')
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and refill an existing --path')
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--operations', type=int, default=2_000)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--executors', choices=EXECUTORS, nargs='+',
+                        default=list(EXECUTORS))
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args(argv)
+    if args.path and os.path.exists(args.path) and not args.reset:
+        parser.error(f'{args.path} exists, pass --reset to overwrite it')
+
+    with TemporaryDirectory() as directory:
+        path = args.path or os.path.join(directory, 'stress.db')
+        url = f'sqlite:///{path}'
+        stored, names = fill(url, args.rows)
+        count = min(args.operations, args.rows)
+        results = {
+            'python': platform.python_version(),
+            'sqlalchemy': sa.__version__,
+            'url': url,
+            'rows': args.rows,
+            'write_ratio': args.write_ratio,
+        }
+        for name in args.executors:
+            runs = {}
+            for workers in args.workers:
+                operations = plan(stored, names, count, args.write_ratio)
+                runs[str(workers)] = run(
+                    EXECUTORS[name], url, workers, operations,
+                )
+            baseline = runs[str(args.workers[0])]['throughput']
+            for result in runs.values():
+                result['scaling'] = result['throughput'] / baseline
+            results[name] = runs
+    json.dump(results, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
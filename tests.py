@@ -0,0 +1,181 @@
+import gc
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import QueuePool
+
+from cache import LRUCache
+import db
+from db import (
+    EngineSettings,
+    IN_MEMORY,
+    make_engine,
+    make_scoped_session,
+    make_sessionmaker,
+    PRODUCTION,
+)
+
+Model = declarative_base()
+
+
+class Plan(Model):
+    __tablename__ = 'plans'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100))
+
+
+class TestMakeEngine(TestCase):
+    def setUp(self) -> None:
+        self.directory = TemporaryDirectory()
+        self.url = f'sqlite:///{self.directory.name}/db.sqlite'
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_applies_pragmas_on_connect(self) -> None:
+        engine = make_engine(self.url)
+        with engine.connect() as connection:
+            pragmas = {
+                name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+                for name in PRODUCTION.pragmas()
+            }
+        engine.dispose()
+
+        self.assertEqual(pragmas, {
+            'journal_mode': 'wal',
+            'synchronous': 1,
+            'cache_size': PRODUCTION.cache_size,
+            'mmap_size': PRODUCTION.mmap_size,
+            'foreign_keys': 1,
+        })
+
+    def test_skips_pragmas_left_unset(self) -> None:
+        settings = EngineSettings(journal_mode=None, foreign_keys=None)
+        engine = make_engine(self.url, settings)
+        with engine.connect() as connection:
+            journal_mode = connection.exec_driver_sql(
+                'PRAGMA journal_mode',
+            ).scalar()
+            foreign_keys = connection.exec_driver_sql(
+                'PRAGMA foreign_keys',
+            ).scalar()
+        engine.dispose()
+
+        self.assertEqual(journal_mode, 'delete')
+        self.assertEqual(foreign_keys, 0)
+
+    def test_sizes_pool_of_file_database(self) -> None:
+        settings = EngineSettings(pool_size=3, max_overflow=2, pool_recycle=60)
+        engine = make_engine(self.url, settings)
+
+        self.assertIsInstance(engine.pool, QueuePool)
+        self.assertEqual(engine.pool.size(), 3)
+        self.assertEqual(engine.pool._max_overflow, 2)
+        self.assertEqual(engine.pool._recycle, 60)
+        self.assertTrue(engine.pool._pre_ping)
+        engine.dispose()
+
+    def test_in_memory_database_skips_pool_size(self) -> None:
+        for settings in (PRODUCTION, IN_MEMORY):
+            with self.subTest(settings=settings):
+                engine = make_engine('sqlite:///', settings)
+                self.assertNotIsInstance(engine.pool, QueuePool)
+                with engine.connect() as connection:
+                    self.assertEqual(
+                        connection.exec_driver_sql('SELECT 1').scalar(), 1,
+                    )
+                engine.dispose()
+
+    def test_options_override_settings(self) -> None:
+        engine = make_engine(self.url, pool_size=1, pool_pre_ping=False)
+
+        self.assertEqual(engine.pool.size(), 1)
+        self.assertFalse(engine.pool._pre_ping)
+        engine.dispose()
+
+    def test_forked_child_drops_inherited_connections(self) -> None:
+        engine = make_engine(self.url)
+        with engine.connect():
+            pass
+        pool = engine.pool
+
+        db._dispose_after_fork()
+
+        self.assertIsNot(engine.pool, pool)
+        self.assertEqual(engine.pool.checkedin(), 0)
+        engine.dispose()
+
+    def test_forgets_collected_engines(self) -> None:
+        engine = make_engine(self.url)
+        self.assertIn(engine, db._engines)
+        collected = weakref.ref(engine)
+
+        del engine
+        gc.collect()
+
+        self.assertIsNone(collected())
+
+
+class TestMakeSessionmaker(TestCase):
+    def setUp(self) -> None:
+        self.engine = make_engine('sqlite:///', IN_MEMORY)
+        Model.metadata.create_all(self.engine)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+
+    def test_binds_sessions_to_engine(self) -> None:
+        session = make_sessionmaker(self.engine)()
+
+        self.assertIs(session.get_bind(), self.engine)
+        session.close()
+
+    def test_options_take_effect(self) -> None:
+        session = make_sessionmaker(self.engine, expire_on_commit=False)()
+        plan = Plan(name='basic')
+        session.add(plan)
+        session.commit()
+
+        self.assertIn('name', vars(plan))
+        session.close()
+
+    def test_expires_on_commit_by_default(self) -> None:
+        session = make_sessionmaker(self.engine)()
+        plan = Plan(name='basic')
+        session.add(plan)
+        session.commit()
+
+        self.assertNotIn('name', vars(plan))
+        session.close()
+
+    def test_scoped_session_reuses_session_per_thread(self) -> None:
+        session = make_scoped_session(self.engine, autoflush=False)
+
+        self.assertIs(session(), session())
+        self.assertFalse(session().autoflush)
+        session.remove()
+
+
+class TestLRUCache(TestCase):
+    def test_shared_between_threads(self) -> None:
+        cache: LRUCache[int, int] = LRUCache(maxsize=64)
+
+        def work(offset: int) -> None:
+            for index in range(2_000):
+                key = (offset + index) % 100
+                if cache.get(key) is None:
+                    cache.put(key, index)
+                if index % 50 == 0:
+                    cache.invalidate(key)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(work, range(8)))
+
+        stats = cache.stats
+        self.assertLessEqual(len(cache), 64)
+        self.assertEqual(stats.hits + stats.misses, 8 * 2_000)
@@ -0,0 +1,123 @@
+import weakref
+from contextlib import contextmanager
+from dataclasses import replace
+from threading import Lock
+from typing import Any, Dict, Iterable, Iterator, Optional, Set, Text
+
+from sqlalchemy.event import listen
+
+from cache import CacheStats, LRUCache
+
+
+class CachedRepository:
+    def __init__(
+            self, repository: Any, maxsize: int, ttl: Optional[float] = None,
+    ) -> None:
+        self._repository = repository
+        self._snapshots: LRUCache[Text, Any] = LRUCache(maxsize, ttl)
+        self._names: LRUCache[Any, Text] = LRUCache(maxsize, ttl)
+        self._generation = 0
+        self._lock = Lock()
+        # Names written in a transaction are kept in its session's info, so
+        # sessions of a scoped_session only settle their own writes.
+        self._pending_key = ('cached_repository_pending', id(self))
+        self._clear_key = ('cached_repository_clear', id(self))
+
+        # Writes only reach the cache once their transaction has ended, so
+        # a rollback can never leave uncommitted snapshots behind.
+        ref = weakref.ref(self)
+
+        def settle(session: Any) -> None:
+            cached = ref()
+            if cached is not None:
+                cached._settle(session)
+
+        listen(repository.session, 'after_commit', settle)
+        listen(repository.session, 'after_rollback', settle)
+
+    @property
+    def stats(self) -> CacheStats:
+        return self._snapshots.stats
+
+    def create(self, name: Text, fee: Any) -> Any:
+        return self._repository.create(name, fee)
+
+    def find(self, name: Text, for_update: bool = True) -> Optional[Any]:
+        if for_update:
+            return self._repository.find(name)
+        if self._bypass(name):
+            return self._repository.read(name)
+        snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            generation = self._generation
+            snapshot = self._repository.read(name)
+            if snapshot is None:
+                return None
+            # A write settled while reading may have made the snapshot stale.
+            with self._lock:
+                if generation == self._generation:
+                    self._snapshots.put(name, snapshot)
+                    self._names.put(snapshot.id, name)
+        return replace(snapshot, fee=replace(snapshot.fee))
+
+    def find_many(self, names: Iterable[Text], **options: Any) -> Dict:
+        return self._repository.find_many(names, **options)
+
+    def read(self, name: Text) -> Optional[Any]:
+        return self._repository.read(name)
+
+    def read_all(self, batch_size: int = 1000) -> Iterator[Any]:
+        return self._repository.read_all(batch_size)
+
+    def save(self, model: Any, **options: Any) -> None:
+        self._mark(model)
+        self._repository.save(model, **options)
+
+    def save_many(self, models: Iterable[Any], **options: Any) -> None:
+        models = list(models)
+        for model in models:
+            self._mark(model)
+        self._repository.save_many(models, **options)
+
+    def reprice(self, criterion: Any, fee: Any) -> int:
+        self._repository.session.info[self._clear_key] = True
+        return self._repository.reprice(criterion, fee)
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator[None]:
+        with self._repository.unit_of_work():
+            yield
+
+    def _bypass(self, name: Text) -> bool:
+        session = self._repository.session
+        pending = (
+            session.info.get(self._clear_key, False)
+            or name in session.info.get(self._pending_key, ())
+        )
+        return (
+            pending
+            or self._repository.in_unit_of_work
+            or bool(session.new or session.dirty or session.deleted)
+        )
+
+    def _mark(self, model: Any) -> None:
+        name = self._names.get(model.id)
+        pending = self._repository.session.info.setdefault(
+            self._pending_key, set(),
+        )
+        pending.add(model.name)
+        if name is not None:
+            pending.add(name)
+
+    def _settle(self, session: Any) -> None:
+        clear = session.info.pop(self._clear_key, False)
+        pending: Set[Text] = session.info.pop(self._pending_key, set())
+        if not clear and not pending:
+            return
+        with self._lock:
+            self._generation += 1
+            if clear:
+                self._snapshots.clear()
+                self._names.clear()
+            for name in pending:
+                self._snapshots.invalidate(name)
@@ -0,0 +1,278 @@
+from decimal import ROUND_HALF_EVEN
+from typing import (
+    Any, Dict, Iterator, List, Optional, Sequence, Text, Tuple,
+)
+
+from sqlalchemy import (
+    and_,
+    BigInteger,
+    bindparam,
+    Column,
+    ForeignKeyConstraint,
+    func,
+    Index,
+    MetaData,
+    select,
+    Table,
+    UniqueConstraint,
+)
+from sqlalchemy.engine import Connection, Row
+from sqlalchemy.schema import AddConstraint, DDLElement
+from sqlalchemy.sql.compiler import DDLCompiler
+from sqlalchemy.ext.compiler import compiles
+
+from utils import chunked
+from .types import to_minor_units
+
+
+class RenameTable(DDLElement):
+    def __init__(self, table: Table, new_name: Text) -> None:
+        self.table = table
+        self.new_name = new_name
+
+
+@compiles(RenameTable)
+def _compile_rename_table(element: RenameTable, compiler: DDLCompiler,
+                          **kw: Any) -> Text:
+    preparer = compiler.preparer
+    return (
+        f'ALTER TABLE {preparer.format_table(element.table)} '
+        f'RENAME TO {preparer.quote(element.new_name)}'
+    )
+
+
+# Converts a float column to BIGINT minor units, rounding half-even. SQLite
+# cannot change a column type or re-add NOT NULL, so there the table is
+# rebuilt following SQLite's documented procedure: with foreign keys off, a
+# copy with the new column type is filled in keyset batches and replaces the
+# original, its indexes are recreated and the references are checked before
+# foreign keys are switched back on. Turning them off only works outside a
+# transaction, so on SQLite with enforced foreign keys the conversion
+# commits. Other dialects alter the table in place.
+def convert_to_minor_units(
+        connection: Connection,
+        table_name: Text,
+        column_name: Text,
+        exponent: int = 2,
+        key: Text = 'id',
+        batch_size: int = 1000,
+) -> int:
+    source = Table(table_name, MetaData(), autoload_with=connection)
+    if connection.dialect.name != 'sqlite':
+        return _alter(
+            connection, source, column_name, exponent, key, batch_size,
+        )
+    if not connection.exec_driver_sql('PRAGMA foreign_keys').scalar():
+        return _rebuild(
+            connection, source, column_name, exponent, key, batch_size,
+        )
+
+    # The switch and the commit it needs go through the driver connection,
+    # so a transaction the caller opened with Engine.begin() stays usable.
+    dbapi_connection = connection.connection.dbapi_connection
+    if dbapi_connection.in_transaction:
+        raise RuntimeError(
+            'Foreign keys cannot be disabled inside a transaction, commit '
+            f'before converting {table_name}.{column_name}.',
+        )
+    connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+    try:
+        converted = _rebuild(
+            connection, source, column_name, exponent, key, batch_size,
+        )
+        violations = connection.exec_driver_sql(
+            'PRAGMA foreign_key_check',
+        ).all()
+        if violations:
+            raise RuntimeError(
+                f'Rebuilding {table_name} broke foreign keys: {violations}',
+            )
+        dbapi_connection.commit()
+    except:
+        dbapi_connection.rollback()
+        raise
+    finally:
+        connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+    return converted
+
+
+def _rebuild(
+        connection: Connection, source: Table, column_name: Text,
+        exponent: int, key: Text, batch_size: int,
+) -> int:
+    # The copy shares the reflected metadata, which also holds the tables
+    # its foreign keys point at.
+    target = Table(
+        f'_{source.name}_minor', source.metadata,
+        *(
+            Column(column.name, BigInteger, nullable=column.nullable)
+            if column.name == column_name else column._copy()
+            for column in source.columns
+        ),
+        *(
+            UniqueConstraint(
+                *(column.name for column in constraint.columns),
+                name=constraint.name,
+            )
+            for constraint in source.constraints
+            if isinstance(constraint, UniqueConstraint)
+        ),
+        *(
+            ForeignKeyConstraint(
+                [element.parent.name for element in constraint.elements],
+                [element.target_fullname for element in constraint.elements],
+                name=constraint.name,
+                onupdate=constraint.onupdate,
+                ondelete=constraint.ondelete,
+            )
+            for constraint in source.foreign_key_constraints
+        ),
+    )
+    target.create(connection)
+
+    converted = 0
+    for rows in _batches(connection, source, key, batch_size):
+        values: List[Dict[Text, Any]] = []
+        for row in rows:
+            value = dict(row._mapping)
+            value[column_name] = _convert(value[column_name], exponent)
+            values.append(value)
+        connection.execute(target.insert(), values)
+        converted += len(rows)
+
+    indexes = [
+        (index.name, [column.name for column in index.columns], index.unique)
+        for index in source.indexes
+    ]
+    source.drop(connection)
+    connection.execute(RenameTable(target, source.name))
+    renamed = Table(source.name, MetaData(), autoload_with=connection)
+    for name, columns, unique in indexes:
+        Index(
+            name, *(renamed.c[column] for column in columns), unique=unique,
+        ).create(connection)
+    return converted
+
+
+def _alter(
+        connection: Connection, source: Table, column_name: Text,
+        exponent: int, key: Text, batch_size: int,
+) -> int:
+    preparer = connection.dialect.identifier_preparer
+    table_name = preparer.format_table(source)
+    column = preparer.quote(column_name)
+    minor = preparer.quote(f'{column_name}_minor')
+    connection.exec_driver_sql(
+        f'ALTER TABLE {table_name} ADD COLUMN {minor} BIGINT',
+    )
+
+    minor_column = Column(f'{column_name}_minor', BigInteger)
+    target = Table(source.name, MetaData(), source.c[key]._copy(),
+                   minor_column, schema=source.schema)
+    update = (
+        target.update()
+        .where(target.c[key] == bindparam('_key'))
+        .values({minor_column.name: bindparam('_minor')})
+    )
+    converted = 0
+    for rows in _batches(connection, source, key, batch_size):
+        connection.execute(update, [
+            {'_key': row._mapping[key],
+             '_minor': _convert(row._mapping[column_name], exponent)}
+            for row in rows
+        ])
+        converted += len(rows)
+
+    connection.exec_driver_sql(
+        f'ALTER TABLE {table_name} DROP COLUMN {column}',
+    )
+    connection.exec_driver_sql(
+        f'ALTER TABLE {table_name} RENAME COLUMN {minor} TO {column}',
+    )
+    if not source.c[column_name].nullable:
+        set_not_null = (
+            f'MODIFY {column} BIGINT NOT NULL'
+            if connection.dialect.name in ('mysql', 'mariadb')
+            else f'ALTER COLUMN {column} SET NOT NULL'
+        )
+        connection.exec_driver_sql(f'ALTER TABLE {table_name} {set_not_null}')
+    return converted
+
+
+def _convert(amount: Optional[float], exponent: int) -> Optional[int]:
+    if amount is None:
+        return None
+    return to_minor_units(amount, exponent, ROUND_HALF_EVEN)
+
+
+def _batches(
+        connection: Connection, source: Table, key: Text, batch_size: int,
+) -> Iterator[List[Row]]:
+    query = select(source).order_by(source.c[key]).limit(batch_size)
+    last_key: Optional[object] = None
+    while True:
+        batch_query = query
+        if last_key is not None:
+            batch_query = query.where(source.c[key] > last_key)
+        rows = connection.execute(batch_query).all()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last_key = rows[-1]._mapping[key]
+
+
+# Merges rows that repeat the values of `columns` into the one with the
+# lowest key, re-pointing every `(table, column)` in `references` at it, and
+# then adds the unique constraint that keeps them merged. SQLite cannot add
+# constraints to an existing table, so there it becomes a unique index.
+def deduplicate(
+        connection: Connection,
+        table_name: Text,
+        columns: Sequence[Text],
+        references: Sequence[Tuple[Text, Text]],
+        constraint_name: Text,
+        key: Text = 'id',
+        batch_size: int = 1000,
+) -> int:
+    metadata = MetaData()
+    source = Table(table_name, metadata, autoload_with=connection)
+    values = [source.c[column] for column in columns]
+    keepers = (
+        select(func.min(source.c[key]).label('keep'), *values)
+        .group_by(*values)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    duplicates = connection.execute(
+        select(source.c[key], keepers.c.keep)
+        .join(keepers, and_(*(
+            source.c[column] == keepers.c[column] for column in columns
+        )))
+        .where(source.c[key] != keepers.c.keep),
+    ).all()
+
+    for table, column in references:
+        referencing = Table(table, metadata, autoload_with=connection)
+        update = (
+            referencing.update()
+            .where(referencing.c[column] == bindparam('_duplicate'))
+            .values({column: bindparam('_keep')})
+        )
+        for chunk in chunked(duplicates, batch_size):
+            connection.execute(update, [
+                {'_duplicate': duplicate, '_keep': keep}
+                for duplicate, keep in chunk
+            ])
+    for chunk in chunked(duplicates, batch_size):
+        connection.execute(source.delete().where(
+            source.c[key].in_([duplicate for duplicate, _ in chunk]),
+        ))
+
+    if connection.dialect.name == 'sqlite':
+        Index(constraint_name, *values, unique=True).create(connection)
+    else:
+        connection.execute(
+            AddConstraint(UniqueConstraint(*values, name=constraint_name)),
+        )
+    return len(duplicates)
@@ -0,0 +1,215 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from typing import (
+    Any, Dict, Iterable, Iterator, List, Literal, Optional, Text, Union,
+)
+
+from sqlalchemy import func, inspect, Select
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+    Query,
+    scoped_session,
+    selectinload,
+    Session,
+)
+from sqlalchemy.orm.interfaces import LoaderOption
+
+from utils import chunked
+
+Loading = Literal['joined', 'selectin', 'lazy']
+
+
+def loaders(relationship: Any) -> Dict[Loading, LoaderOption]:
+    return {
+        'joined': joinedload(relationship, innerjoin=True),
+        'selectin': selectinload(relationship),
+        'lazy': lazyload(relationship),
+    }
+
+
+class SqlRepository(ABC):
+    model: type
+    dto: type
+    money_dto: type
+    fee_total_dto: type
+    chunk_size = 500
+    fee_loaders: Dict[Loading, LoaderOption] = {}
+
+    def __init__(
+            self,
+            session: Union[Session, scoped_session],
+            loading: Loading = 'joined',
+    ) -> None:
+        self._session = session
+        self._loading = loading
+
+    @property
+    def session(self) -> Union[Session, scoped_session]:
+        return self._session
+
+    @property
+    def in_unit_of_work(self) -> bool:
+        return self._in_unit_of_work
+
+    @property
+    def query(self) -> Query:
+        return self._session.query(self.model)
+
+    @property
+    def _in_unit_of_work(self) -> bool:
+        return self._session.info.get('in_unit_of_work', False)
+
+    @_in_unit_of_work.setter
+    def _in_unit_of_work(self, value: bool) -> None:
+        self._session.info['in_unit_of_work'] = value
+
+    def find_many(
+            self,
+            names: Iterable[Text],
+            for_update: bool = False,
+            loading: Optional[Loading] = None,
+    ) -> Dict[Text, object]:
+        found = {}
+        for chunk in chunked(set(names), self.chunk_size):
+            query = self.query.options(*self._options(loading)).filter(
+                self.model.name.in_(chunk),
+            )
+            if for_update:
+                query = query.with_for_update()
+            found.update((model.name, model) for model in query)
+        return found
+
+    def iter_all(
+            self, batch_size: int = 1000, after: Optional[Text] = None,
+    ) -> Iterator[List[Any]]:
+        name = self.model.name
+        query = self.query.options(*self._options()).order_by(name)
+        while True:
+            page = query if after is None else query.filter(name > after)
+            batch = page.limit(batch_size).all()
+            if not batch:
+                return
+            after = batch[-1].name
+            try:
+                yield batch
+            finally:
+                for model in batch:
+                    self._expunge(model)
+            if len(batch) < batch_size:
+                return
+
+    def read(self, name: Text) -> Optional[Any]:
+        query = self._projection().where(self.model.__table__.c.name == name)
+        row = self._session.execute(query).one_or_none()
+        return row and self._to_dto(row)
+
+    def read_all(self, batch_size: int = 1000) -> Iterator[Any]:
+        query = (
+            self._projection()
+            .order_by(self.model.__table__.c.name)
+            .execution_options(yield_per=batch_size)
+        )
+        for row in self._session.execute(query):
+            yield self._to_dto(row)
+
+    def fee_totals(
+            self,
+            name_like: Optional[Text] = None,
+            created_from: Optional[datetime] = None,
+            created_to: Optional[datetime] = None,
+    ) -> List[Any]:
+        columns = self.model.__table__.c
+        projection = self._projection()
+        _, _, amount, currency = projection.selected_columns
+        query = projection.with_only_columns(
+            currency, func.sum(amount), func.count(),
+        ).group_by(currency).order_by(currency)
+        if name_like is not None:
+            query = query.where(columns.name.like(name_like))
+        if created_from is not None:
+            query = query.where(columns.when_created >= created_from)
+        if created_to is not None:
+            query = query.where(columns.when_created < created_to)
+        return [
+            self.fee_total_dto(self.money_dto(total, currency), count)
+            for currency, total, count in self._session.execute(query)
+        ]
+
+    @abstractmethod
+    def save(self, model: object) -> None:
+        ...
+
+    def save_many(
+            self, models: Iterable[object], chunk_size: Optional[int] = None,
+    ) -> None:
+        with self.unit_of_work():
+            for chunk in chunked(models, chunk_size or self.chunk_size):
+                for model in chunk:
+                    self.save(model)
+                self._session.flush()
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator[None]:
+        if self._in_unit_of_work:
+            yield
+            return
+        self._in_unit_of_work = True
+        try:
+            yield
+        except:
+            self._session.rollback()
+            raise
+        finally:
+            self._in_unit_of_work = False
+        self._commit()
+
+    def _created(self, model: Any) -> Any:
+        inspect(model).info['created'] = True
+        return model
+
+    def _attach(self, model: object, load: bool = True) -> None:
+        if model in self._session:
+            return
+        state = inspect(model)
+        if state.transient and state.info.get('created'):
+            self._session.add(model)
+        elif state.detached and not load and (
+                state.key not in self._session.identity_map):
+            # Re-attaching keeps the changes tracked while detached, which
+            # then flush as an UPDATE without loading the row first.
+            self._session.add(model)
+        else:
+            self._session.merge(model)
+
+    def _commit(self) -> None:
+        if self._in_unit_of_work:
+            return
+        try:
+            self._session.commit()
+        except:
+            self._session.rollback()
+            raise
+
+    def _expunge(self, model: Any) -> None:
+        self._session.expunge(model)
+
+    @abstractmethod
+    def _projection(self) -> Select:
+        ...
+
+    def _to_dto(self, row: Row) -> Any:
+        subscription_id, name, amount, currency = row
+        return self.dto(
+            subscription_id, name, self.money_dto(Decimal(amount), currency),
+        )
+
+    def _options(
+            self, loading: Optional[Loading] = None,
+    ) -> List[LoaderOption]:
+        if not self.fee_loaders:
+            return []
+        return [self.fee_loaders[loading or self._loading]]
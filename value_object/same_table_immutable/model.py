@@ -3,11 +3,22 @@ from decimal import Decimal
 from typing import Optional, Text
 from uuid import uuid1
 
-from sqlalchemy import Column, DateTime, Float, String, Table
-from sqlalchemy.orm import Session
-from sqlalchemy_utils import CurrencyType, UUIDType
+from sqlalchemy import (
+    Column,
+    DateTime,
+    inspect,
+    select,
+    Select,
+    String,
+    Table,
+    update,
+)
+from sqlalchemy.sql import ColumnElement
+from sqlalchemy_utils import UUIDType
 
 from db import Base
+from ..repository import SqlRepository
+from ..types import InternedCurrencyType, MinorUnits
 from . import entity
 
 
@@ -19,8 +30,10 @@ class Subscription(entity.Subscription, Base):
     name = Column(String(100), nullable=False, index=True, unique=True)
     when_created = Column(DateTime, nullable=False, default=datetime.utcnow)
     when_updated = Column(DateTime, nullable=True, onupdate=datetime.utcnow)
-    _fee_amount = Column('fee_amount', Float(asdecimal=True), nullable=False)
-    _fee_currency = Column('fee_currency', CurrencyType, nullable=False)
+    _fee_amount = Column('fee_amount', MinorUnits(), nullable=False)
+    _fee_currency = Column(
+        'fee_currency', InternedCurrencyType(), nullable=False,
+    )
 
     @property
     def fee(self) -> entity.Money:
@@ -28,6 +41,15 @@ class Subscription(entity.Subscription, Base):
 
     @fee.setter
     def fee(self, value: entity.Money) -> None:
+        # A persistent instance is expired after every commit, so its fee is
+        # loaded to compare against rather than taken from the stale dict.
+        if inspect(self).persistent:
+            current = self._fee_amount, self._fee_currency
+        else:
+            loaded = inspect(self).dict
+            current = loaded.get('_fee_amount'), loaded.get('_fee_currency')
+        if current == (value.amount, value.currency):
+            return
         self._fee_amount = value.amount
         self._fee_currency = value.currency
 
@@ -35,24 +57,48 @@ class Subscription(entity.Subscription, Base):
         return hash(self.id)
 
 
-class Repository(entity.Repository):
-    def __init__(self, session: Session) -> None:
-        self._session = session
-        self.query = session.query(Subscription)
+class Repository(SqlRepository, entity.Repository):
+    model = Subscription
+    dto = entity.Subscription
+    money_dto = entity.Money
+    fee_total_dto = entity.FeeTotal
 
     def create(self, name: Text, fee: entity.Money) -> Subscription:
-        return Subscription(id=uuid1(), name=name, fee=fee)
-
-    def find(self, name: Text) -> Optional[entity.Subscription]:
-        return self.query.with_for_update().filter_by(name=name).one_or_none()
-
-    def save(self, model: Subscription) -> None:
-        self._session.merge(model)
-        try:
-            self._session.commit()
-        except:
-            self._session.rollback()
-            raise
+        return self._created(Subscription(id=uuid1(), name=name, fee=fee))
+
+    def find(
+            self, name: Text, for_update: bool = True,
+    ) -> Optional[entity.Subscription]:
+        query = self.query.filter_by(name=name)
+        if for_update:
+            query = query.with_for_update()
+        return query.one_or_none()
+
+    def reprice(self, criterion: ColumnElement, fee: entity.Money) -> int:
+        columns = Subscription.__table__.c
+        query = (
+            update(Subscription)
+            .where(criterion)
+            .values({
+                columns.fee_amount: fee.amount,
+                columns.fee_currency: fee.currency,
+                columns.when_updated: datetime.utcnow(),
+            })
+            .execution_options(synchronize_session='fetch')
+        )
+        repriced = self._session.execute(query).rowcount
+        self._commit()
+        return repriced
+
+    def _projection(self) -> Select:
+        columns = Subscription.__table__.c
+        return select(
+            columns.id, columns.name, columns.fee_amount, columns.fee_currency,
+        )
+
+    def save(self, model: Subscription, load: bool = True) -> None:
+        self._attach(model, load)
+        self._commit()
 
 
 table = Subscription.__table__
@@ -1,6 +1,17 @@
 from dataclasses import dataclass
+from datetime import datetime
 from decimal import Decimal
-from typing import NewType, Optional, Protocol, Text
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NewType,
+    Optional,
+    Protocol,
+    Text,
+)
 from uuid import UUID
 
 Currency = NewType('Currency', Text)
@@ -12,6 +23,12 @@ class Money:
     currency: Currency
 
 
+@dataclass(frozen=True)
+class FeeTotal:
+    total: Money
+    count: int
+
+
 @dataclass
 class Subscription:
     id: UUID
@@ -23,8 +40,38 @@ class Repository(Protocol):
     def create(self, name: Text, fee: Money) -> Subscription:
         ...
 
-    def find(self, name: Text) -> Optional[Subscription]:
+    def find(
+            self, name: Text, for_update: bool = True,
+    ) -> Optional[Subscription]:
+        ...
+
+    def find_many(self, names: Iterable[Text]) -> Dict[Text, Subscription]:
+        ...
+
+    def iter_all(
+            self, batch_size: int, after: Optional[Text] = None,
+    ) -> Iterator[List[Subscription]]:
+        ...
+
+    def read(self, name: Text) -> Optional[Subscription]:
+        ...
+
+    def read_all(self, batch_size: int) -> Iterator[Subscription]:
+        ...
+
+    def fee_totals(
+            self,
+            name_like: Optional[Text] = None,
+            created_from: Optional[datetime] = None,
+            created_to: Optional[datetime] = None,
+    ) -> List[FeeTotal]:
+        ...
+
+    def reprice(self, criterion: Any, fee: Money) -> int:
         ...
 
     def save(self, dto: Subscription) -> None:
         ...
+
+    def save_many(self, dtos: Iterable[Subscription]) -> None:
+        ...
@@ -3,12 +3,26 @@ from decimal import Decimal
 from typing import Any, Optional, Text, Tuple
 from uuid import uuid1
 
-from sqlalchemy import Column, DateTime, Float, String, Table
+from sqlalchemy import (
+    Column,
+    DateTime,
+    select,
+    Select,
+    String,
+    Table,
+    update,
+)
+from sqlalchemy.event import listens_for
 from sqlalchemy.ext.mutable import MutableComposite
-from sqlalchemy.orm import composite, Session
-from sqlalchemy_utils import CurrencyType, UUIDType
+from sqlalchemy.orm import composite
+from sqlalchemy.orm.attributes import Event
+from sqlalchemy.orm.base import NO_VALUE
+from sqlalchemy.sql import ColumnElement
+from sqlalchemy_utils import UUIDType
 
 from db import Base
+from ..repository import SqlRepository
+from ..types import InternedCurrencyType, MinorUnits
 from . import entity
 
 
@@ -17,8 +31,10 @@ class Money(entity.Money, MutableComposite):
         return self.amount, self.currency
 
     def __setattr__(self, key: Text, value: Any) -> None:
+        previous = vars(self).get(key, NO_VALUE)
         super().__setattr__(key, value)
-        self.changed()
+        if previous is not NO_VALUE and previous != value:
+            self.changed()
 
     @classmethod
     def coerce(cls, key: Text, value: entity.Money) -> 'Money':
@@ -39,34 +55,70 @@ class Subscription(entity.Subscription, Base):
     when_created = Column(DateTime, nullable=False, default=datetime.utcnow)
     when_updated = Column(DateTime, nullable=True, onupdate=datetime.utcnow)
 
+    # Active history loads an expired fee, so the set listener below can
+    # keep an equal one after a commit instead of rewriting the columns.
     fee = composite(
         Money,
-        Column('fee_amount', Float(asdecimal=True), nullable=False),
-        Column('fee_currency', CurrencyType, nullable=False),
+        Column('fee_amount', MinorUnits(), nullable=False),
+        Column('fee_currency', InternedCurrencyType(), nullable=False),
+        active_history=True,
     )
 
     def __hash__(self):
         return hash(self.id)
 
 
-class Repository(entity.Repository):
-    def __init__(self, session: Session) -> None:
-        self._session = session
-        self.query = session.query(Subscription)
+@listens_for(Subscription.fee, 'set', retval=True)
+def keep_equal_fee_on_set(
+        t: Subscription, value: Optional[entity.Money], old: Any, e: Event,
+) -> Optional[entity.Money]:
+    if value is None or old is None or old is NO_VALUE:
+        return value
+    return old if old == value else value
+
+
+class Repository(SqlRepository, entity.Repository):
+    model = Subscription
+    dto = entity.Subscription
+    money_dto = entity.Money
+    fee_total_dto = entity.FeeTotal
 
     def create(self, name: Text, fee: entity.Money) -> Subscription:
-        return Subscription(id=uuid1(), name=name, fee=fee)
-
-    def find(self, name: Text) -> Optional[entity.Subscription]:
-        return self.query.with_for_update().filter_by(name=name).one_or_none()
-
-    def save(self, model: Subscription) -> None:
-        self._session.merge(model)
-        try:
-            self._session.commit()
-        except:
-            self._session.rollback()
-            raise
+        return self._created(Subscription(id=uuid1(), name=name, fee=fee))
+
+    def find(
+            self, name: Text, for_update: bool = True,
+    ) -> Optional[entity.Subscription]:
+        query = self.query.filter_by(name=name)
+        if for_update:
+            query = query.with_for_update()
+        return query.one_or_none()
+
+    def reprice(self, criterion: ColumnElement, fee: entity.Money) -> int:
+        columns = Subscription.__table__.c
+        query = (
+            update(Subscription)
+            .where(criterion)
+            .values({
+                columns.fee_amount: fee.amount,
+                columns.fee_currency: fee.currency,
+                columns.when_updated: datetime.utcnow(),
+            })
+            .execution_options(synchronize_session='fetch')
+        )
+        repriced = self._session.execute(query).rowcount
+        self._commit()
+        return repriced
+
+    def _projection(self) -> Select:
+        columns = Subscription.__table__.c
+        return select(
+            columns.id, columns.name, columns.fee_amount, columns.fee_currency,
+        )
+
+    def save(self, model: Subscription, load: bool = True) -> None:
+        self._attach(model, load)
+        self._commit()
 
 
 table = Subscription.__table__
@@ -1,15 +1,20 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from decimal import Decimal
 from random import choice, randrange
-from typing import Tuple
+from typing import Iterator, List, Tuple
 from unittest.case import TestCase
 from uuid import UUID, uuid1
 
-from sqlalchemy import Column
+from sqlalchemy import Column, inspect, select
+from sqlalchemy.event import listen, remove
 from sqlalchemy.orm import sessionmaker
 
 from . import model
+from cache import CacheStats
 from db import memory_engine, metadata
-from .entity import Currency, Money, Subscription
+from ..cache import CachedRepository
+from .entity import Currency, FeeTotal, Money, Subscription
 
 TABLE = model.Subscription.__table__
 AMOUNT_C = TABLE.c.fee_amount
@@ -61,24 +66,288 @@ class TestMutableMapping(TestCase):
         subscription = self.given_active_subscription()
         other = self.given_active_subscription()
 
-        subscription.fee = other.fee
+        other_fee = other.fee
+        subscription.fee = other_fee
         self.repository.save(subscription)
 
         db_amount, db_currency = self.get_db_values(
             subscription.id, AMOUNT_C, CURRENCY_C,
         )
-        self.assertAlmostEqual(float(db_amount), float(other.fee.amount))
-        self.assertEqual(db_currency, other.fee.currency)
+        self.assertAlmostEqual(float(db_amount), float(other_fee.amount))
+        self.assertEqual(db_currency, other_fee.currency)
+
+    def test_find_many_by_names(self) -> None:
+        ids = {
+            subscription.name: subscription.id
+            for subscription in (
+                self.given_active_subscription() for _ in range(3)
+            )
+        }
+        self.session.expunge_all()
+
+        found = self.repository.find_many([*ids, 'missing'])
+
+        self.assertEqual(set(found), set(ids))
+        for name, subscription_id in ids.items():
+            self.assertEqual(found[name].id, subscription_id)
+
+    def test_save_many_in_single_transaction(self) -> None:
+        commits = []
+        listen(self.session, 'after_commit', commits.append)
+        subscriptions = [self.given_new_subscription() for _ in range(5)]
+
+        self.repository.save_many(subscriptions, chunk_size=2)
+
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(self.session.query(model.Subscription).count(), 5)
+
+    def test_unit_of_work_postpones_commit(self) -> None:
+        with self.assertRaises(RuntimeError):
+            with self.repository.unit_of_work():
+                self.repository.save(self.given_new_subscription())
+                self.repository.save(self.given_new_subscription())
+                raise RuntimeError
+
+        self.assertEqual(self.session.query(model.Subscription).count(), 0)
+
+    def test_save_new_subscription_without_select(self) -> None:
+        subscription = self.given_new_subscription()
+
+        with self.statements() as statements:
+            self.repository.save(subscription)
+
+        self.assertEqual(
+            [statement.split()[0] for statement in statements], ['INSERT'],
+        )
+
+    def test_save_transient_subscription_with_existing_id(self) -> None:
+        subscription = self.given_active_subscription()
+        new_fee = Money(Decimal('11.3'), Currency('PLN'))
+        copy = model.Subscription(
+            id=subscription.id, name=subscription.name, fee=new_fee,
+        )
+
+        self.repository.save(copy)
+
+        self.assertEqual(self.session.query(model.Subscription).count(), 1)
+        self.assertEqual(self.repository.read(subscription.name).fee, new_fee)
+
+    def test_save_detached_subscription_without_load(self) -> None:
+        subscription = self.given_active_subscription()
+        self.session.refresh(subscription)
+        self.session.expunge(subscription)
+
+        with self.statements() as statements:
+            self.repository.save(subscription, load=False)
+
+        self.assertEqual(statements, [])
+        self.assertEqual(
+            self.repository.find(subscription.name).id, subscription.id,
+        )
+
+    def test_save_changed_detached_subscription_without_load(self) -> None:
+        subscription = self.given_active_subscription()
+        self.session.refresh(subscription)
+        self.session.expunge(subscription)
+        new_fee = Money(Decimal('11.30'), Currency('PLN'))
+        subscription.fee = new_fee
+
+        with self.statements() as statements:
+            self.repository.save(subscription, load=False)
+
+        self.assertEqual(
+            [statement.split()[0] for statement in statements], ['UPDATE'],
+        )
+        self.assertEqual(self.repository.read(subscription.name).fee, new_fee)
+
+    def test_read_plain_entities(self) -> None:
+        subscription = self.given_active_subscription()
+        name, subscription_id = subscription.name, subscription.id
+        self.session.expunge_all()
+
+        found = self.repository.read(name)
+
+        self.assertIs(type(found), Subscription)
+        self.assertIs(type(found.fee), Money)
+        self.assertEqual(found.id, subscription_id)
+        self.assertIsNone(self.repository.read('missing'))
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_read_all_streams_entities(self) -> None:
+        names = sorted(
+            self.given_active_subscription().name for _ in range(5)
+        )
+        self.session.expunge_all()
+
+        found = list(self.repository.read_all(batch_size=2))
+
+        self.assertEqual([dto.name for dto in found], names)
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_cached_find_invalidated_on_save(self) -> None:
+        repository = CachedRepository(self.repository, maxsize=10)
+        subscription = self.given_active_subscription()
+        name = subscription.name
+
+        first = repository.find(name, for_update=False)
+        second = repository.find(name, for_update=False)
+        subscription.fee = Money(Decimal('11.3'), Currency('PLN'))
+        repository.save(subscription)
+        third = repository.find(name, for_update=False)
+
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual(third.fee.currency, 'PLN')
+        self.assertEqual(
+            repository.stats, CacheStats(hits=1, misses=2, evictions=0),
+        )
+
+    def test_cached_find_ignores_rolled_back_changes(self) -> None:
+        repository = CachedRepository(self.repository, maxsize=10)
+        subscription = self.given_active_subscription()
+        name = subscription.name
+        original = repository.find(name, for_update=False).fee
+
+        with self.assertRaises(RuntimeError):
+            with repository.unit_of_work():
+                subscription.fee = Money(Decimal('99.00'), Currency('EUR'))
+                repository.save(subscription)
+                found = repository.find(name, for_update=False)
+                self.assertEqual(found.fee.amount, Decimal('99.00'))
+                raise RuntimeError
+
+        self.assertEqual(repository.find(name, for_update=False).fee, original)
+        self.assertEqual(self.repository.read(name).fee, original)
+
+    def test_iter_all_in_keyset_batches(self) -> None:
+        names = sorted(
+            self.given_active_subscription().name for _ in range(5)
+        )
+        self.session.expunge_all()
+
+        batches = []
+        for batch in self.repository.iter_all(batch_size=2, after=names[0]):
+            batches.append([subscription.name for subscription in batch])
+            self.assertEqual(len(self.session.identity_map), len(batch))
+
+        self.assertEqual(batches, [names[1:3], names[3:5]])
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_iter_all_expunges_batch_when_loop_stops_early(self) -> None:
+        for _ in range(3):
+            self.given_active_subscription()
+        self.session.expunge_all()
+
+        for batch in self.repository.iter_all(batch_size=2):
+            break
+        with self.assertRaises(RuntimeError):
+            for batch in self.repository.iter_all(batch_size=2):
+                raise RuntimeError
+
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_fee_totals_per_currency(self) -> None:
+        for name, amount, currency in [
+            ('basic-1', '10.50', 'EUR'),
+            ('basic-2', '4.25', 'EUR'),
+            ('pro-1', '99.99', 'USD'),
+        ]:
+            fee = Money(Decimal(amount), Currency(currency))
+            self.repository.save(self.repository.create(name, fee))
+        self.session.expunge_all()
+        tomorrow = datetime.utcnow() + timedelta(days=1)
+
+        totals = self.repository.fee_totals()
+        pro_totals = self.repository.fee_totals(name_like='pro-%')
+        future_totals = self.repository.fee_totals(created_from=tomorrow)
+
+        self.assertEqual(totals, [
+            FeeTotal(Money(Decimal('14.75'), Currency('EUR')), 2),
+            FeeTotal(Money(Decimal('99.99'), Currency('USD')), 1),
+        ])
+        self.assertEqual(pro_totals, [
+            FeeTotal(Money(Decimal('99.99'), Currency('USD')), 1),
+        ])
+        self.assertEqual(future_totals, [])
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_reprice_with_set_based_update(self) -> None:
+        basic = [self.given_active_subscription() for _ in range(3)]
+        other = self.given_active_subscription()
+        names = [subscription.name for subscription in basic]
+        new_fee = Money(Decimal('19.99'), Currency('PLN'))
+
+        with self.repository.unit_of_work():
+            loaded = self.repository.find(names[0])
+            self.assertIsNotNone(loaded.fee)
+            with self.statements() as statements:
+                repriced = self.repository.reprice(
+                    TABLE.c.name.in_(names), new_fee,
+                )
+            self.assertEqual(loaded.fee, new_fee)
+
+        self.assertEqual(repriced, 3)
+        self.assertFalse([s for s in statements if s.startswith('INSERT')])
+        for name in names:
+            found = self.repository.read(name)
+            self.assertEqual(found.fee, new_fee)
+        self.assertNotEqual(self.repository.read(other.name).fee, new_fee)
+        when_updated = self.session.execute(
+            select(TABLE.c.when_updated).where(TABLE.c.id == basic[0].id),
+        ).scalar_one()
+        self.assertIsNotNone(when_updated)
+
+    def test_assigning_equal_fee_writes_nothing(self) -> None:
+        subscription = self.given_active_subscription()
+        fee = subscription.fee
+
+        subscription.fee = Money(fee.amount, fee.currency)
+        subscription.fee.amount = fee.amount
+        self.assertFalse(self.session.is_modified(subscription))
+        with self.statements() as statements:
+            self.session.flush()
+
+        self.assertEqual(statements, [])
+        self.assertIsNone(subscription.when_updated)
+
+    def test_assigning_equal_fee_after_commit_writes_nothing(self) -> None:
+        fee = Money(Decimal('10.50'), Currency('EUR'))
+        subscription = self.repository.create('basic', fee)
+        self.repository.save(subscription)
+        self.assertIn('when_updated', inspect(subscription).expired_attributes)
+
+        with self.statements() as statements:
+            subscription.fee = Money(fee.amount, fee.currency)
+            self.repository.save(subscription)
+
+        self.assertFalse([s for s in statements if s.startswith('UPDATE')])
+        self.assertIsNone(subscription.when_updated)
 
     def given_active_subscription(self) -> Subscription:
+        subscription = self.given_new_subscription()
+        self.repository.save(subscription)
+        return subscription
+
+    def given_new_subscription(self) -> Subscription:
         fee = Money(
-            amount=Decimal(randrange(1000, 53400)/100),
+            amount=Decimal(randrange(1000, 53400)).scaleb(-2),
             currency=choice([Currency('EUR'), Currency('GBP'), Currency('USD')])
         )
         name = uuid1().hex
-        subscription = self.repository.create(name, fee)
-        self.repository.save(subscription)
-        return subscription
+        return self.repository.create(name, fee)
+
+    @contextmanager
+    def statements(self) -> Iterator[List[str]]:
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args) -> None:
+            statements.append(statement)
+
+        listen(memory_engine, 'before_cursor_execute', before_execute)
+        try:
+            yield statements
+        finally:
+            remove(memory_engine, 'before_cursor_execute', before_execute)
 
     def get_db_values(self, subscription_id: UUID, *columns: Column) -> Tuple:
         self.session.expunge_all()
@@ -0,0 +1,75 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import or_, select
+from sqlalchemy.engine import Connection, Engine, Row
+
+from .model import fee_table, insert_fee, interned_table, table
+
+
+# A move, not a copy: every batch of subscriptions is inserted into the
+# interned tables and deleted with its private fee rows in one transaction,
+# so a run can be interrupted and resumed. Subscriptions whose id or name is
+# already interned stay where they are for inspection.
+def migrate_to_interned(engine: Engine, batch_size: int = 1000) -> int:
+    migrated = 0
+    last_id = None
+    while True:
+        with engine.begin() as connection:
+            rows = _batch(connection, batch_size, last_id)
+            if not rows:
+                return migrated
+            interned = connection.execute(
+                select(interned_table.c.id, interned_table.c.name).where(or_(
+                    interned_table.c.id.in_([row.id for row in rows]),
+                    interned_table.c.name.in_([row.name for row in rows]),
+                )),
+            ).all()
+            taken = {row.id for row in interned} | {
+                row.name for row in interned
+            }
+            fee_ids: Dict[Tuple[Any, Any], int] = {}
+            values, moved = [], []
+            for row in rows:
+                if row.id in taken or row.name in taken:
+                    continue
+                key = row.amount, row.currency
+                if key not in fee_ids:
+                    fee_ids[key] = insert_fee(connection, *key)
+                values.append({
+                    'id': row.id,
+                    'name': row.name,
+                    'when_created': row.when_created,
+                    'when_updated': row.when_updated,
+                    'fee_id': fee_ids[key],
+                })
+                moved.append(row)
+            if values:
+                connection.execute(interned_table.insert(), values)
+                connection.execute(table.delete().where(
+                    table.c.id.in_([row.id for row in moved]),
+                ))
+                connection.execute(fee_table.delete().where(
+                    fee_table.c.id.in_([row.fee_id for row in moved]),
+                ))
+            migrated += len(values)
+        if len(rows) < batch_size:
+            return migrated
+        last_id = rows[-1].id
+
+
+def _batch(
+        connection: Connection, batch_size: int, last_id: Optional[Any],
+) -> List[Row]:
+    query = (
+        select(
+            table.c.id, table.c.name, table.c.when_created,
+            table.c.when_updated, table.c.fee_id,
+            fee_table.c.amount, fee_table.c.currency,
+        )
+        .join_from(table, fee_table)
+        .order_by(table.c.id)
+        .limit(batch_size)
+    )
+    if last_id is not None:
+        query = query.where(table.c.id > last_id)
+    return connection.execute(query).all()
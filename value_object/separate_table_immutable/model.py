@@ -1,32 +1,62 @@
 from datetime import datetime
-from typing import Any, Optional, Text
+from typing import (
+    Any, Dict, Iterable, List, Optional, Sequence, Text, Tuple, Type, Union,
+)
 from uuid import uuid1
 
 from sqlalchemy import (
     Column,
     DateTime,
-    Float,
+    delete,
+    exists,
     ForeignKey,
+    inspect,
     Integer,
+    select,
+    Select,
     String,
     Table,
+    UniqueConstraint,
+    update,
 )
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
 from sqlalchemy.event import listens_for
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (
+    make_transient_to_detached,
+    relationship,
+    scoped_session,
+    Session,
+)
 from sqlalchemy.orm.attributes import Event
-from sqlalchemy_utils import CurrencyType, UUIDType
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import ColumnElement
+from sqlalchemy_utils import UUIDType
 
+from cache import LRUCache
 from db import Base
+from utils import chunked
+from ..repository import loaders, Loading, SqlRepository
+from ..types import (
+    intern_currency,
+    InternedCurrencyType,
+    MinorUnits,
+    to_minor_units,
+)
 from . import entity
 
+FeeKey = Tuple[int, Text]
 
-class Fee(entity.Money, Base):
-    __table__: Table
-    __tablename__ = 'mutable_separate_vo_fees'
+FEE_CACHE_SIZE = 1024
+
+UPSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
 
+
+class FeeColumns:
     id = Column(Integer, primary_key=True, autoincrement=True)
-    amount = Column(Float(asdecimal=True), nullable=False)
-    currency = Column(CurrencyType, nullable=False)
+    amount = Column(MinorUnits(), nullable=False)
+    currency = Column(InternedCurrencyType(), nullable=False)
 
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, entity.Money):
@@ -36,14 +66,22 @@ class Fee(entity.Money, Base):
         return same_amount and same_currency
 
 
-class Subscription(entity.Subscription, Base):
-    __table__: Table
-    __tablename__ = 'mutable_separate_vo_subscription_plans'
-
+class SubscriptionColumns:
     id = Column(UUIDType(binary=True), primary_key=True)
     name = Column(String(100), nullable=False, index=True, unique=True)
     when_created = Column(DateTime, nullable=False, default=datetime.utcnow)
     when_updated = Column(DateTime, nullable=True, onupdate=datetime.utcnow)
+
+
+class Fee(FeeColumns, entity.Money, Base):
+    __table__: Table
+    __tablename__ = 'mutable_separate_vo_fees'
+
+
+class Subscription(SubscriptionColumns, entity.Subscription, Base):
+    __table__: Table
+    __tablename__ = 'mutable_separate_vo_subscription_plans'
+
     fee_id = Column(Integer, ForeignKey(Fee.id), nullable=False)
     fee = relationship(
         Fee, cascade='save-update,merge,delete,delete-orphan', uselist=False,
@@ -51,33 +89,327 @@ class Subscription(entity.Subscription, Base):
     )
 
 
+# The interning mode: fee rows are unique on their value and shared by
+# reference, so the table grows with distinct prices instead of with churn.
+# Shared rows cannot be deleted as orphans of one subscription; the flush
+# hooks below delete them once nothing references them any more.
+class InternedFee(FeeColumns, entity.Money, Base):
+    __table__: Table
+    __tablename__ = 'mutable_separate_vo_interned_fees'
+    __table_args__ = (
+        UniqueConstraint('amount', 'currency', name='interned_fee_value'),
+    )
+
+
+class InternedSubscription(SubscriptionColumns, entity.Subscription, Base):
+    __table__: Table
+    __tablename__ = 'mutable_separate_vo_interned_subscription_plans'
+
+    fee_id = Column(Integer, ForeignKey(InternedFee.id), nullable=False)
+    fee = relationship(
+        InternedFee, cascade='save-update,merge', uselist=False,
+        backref='subscriptions',
+    )
+
+
 @listens_for(Subscription.fee, 'set', retval=True)
 def convert_money_to_fee_on_set(
         t: Subscription, value: entity.Money, old: Optional[Fee], e: Event,
 ) -> Fee:
+    if isinstance(old, Fee) and old == value:
+        return old
     return Fee(value.amount, value.currency)
 
 
-class Repository(entity.Repository):
-    def __init__(self, session: Session) -> None:
-        self._session = session
-        self.query = session.query(Subscription)
+@listens_for(InternedSubscription.fee, 'set', retval=True)
+def convert_money_to_interned_fee_on_set(
+        t: InternedSubscription, value: entity.Money,
+        old: Optional[InternedFee], e: Event,
+) -> InternedFee:
+    if isinstance(value, InternedFee):
+        return value
+    if isinstance(old, InternedFee) and old == value:
+        return old
+    return InternedFee(value.amount, value.currency)
+
+
+def fee_key(money: entity.Money) -> FeeKey:
+    exponent = InternedFee.__table__.c.amount.type.exponent
+    amount = to_minor_units(money.amount, exponent)
+    return amount, intern_currency(money.currency).code
 
-    def create(self, name: Text, fee: entity.Money) -> Subscription:
-        return Subscription(id=uuid1(), name=name, fee=fee)
 
-    def find(self, name: Text) -> Optional[entity.Subscription]:
-        return self.query.with_for_update().filter_by(name=name).one_or_none()
+def fee_cache(session: Session) -> LRUCache[FeeKey, int]:
+    cache = session.info.get('fee_ids')
+    if cache is None:
+        cache = session.info['fee_ids'] = LRUCache(FEE_CACHE_SIZE)
+    return cache
+
+
+def find_fee(session: Session, money: entity.Money) -> Optional[InternedFee]:
+    key = fee_key(money)
+    cache = fee_cache(session)
+    fee_id = cache.get(key)
+    with session.no_autoflush:
+        if fee_id is not None:
+            # Another session may have collected the cached row since, so it
+            # is trusted only when loaded in this transaction or re-read.
+            fee = session.get(InternedFee, fee_id)
+            if fee is not None and fee_key(fee) == key:
+                return fee
+            cache.invalidate(key)
+        fee = session.scalars(select(InternedFee).where(
+            InternedFee.amount == money.amount,
+            InternedFee.currency == key[1],
+        )).one_or_none()
+    if fee is not None:
+        cache.put(key, fee.id)
+    return fee
+
+
+def intern_fee(session: Session, money: entity.Money) -> InternedFee:
+    fee = find_fee(session, money)
+    if fee is not None:
+        return fee
+    key = fee_key(money)
+    with session.no_autoflush:
+        fee_id = insert_fee(session, money.amount, key[1])
+    fee = session.identity_map.get(identity_key(InternedFee, fee_id))
+    if fee is None:
+        fee = InternedFee(money.amount, key[1])
+        fee.id = fee_id
+        make_transient_to_detached(fee)
+        session.add(fee)
+    fee_cache(session).put(key, fee_id)
+    return fee
+
+
+def insert_fee(
+        connection: Union[Session, Connection], amount: Any, currency: Text,
+) -> int:
+    fees = InternedFee.__table__
+    values = {'amount': amount, 'currency': currency}
+    existing = select(fees.c.id).where(
+        fees.c.amount == amount, fees.c.currency == currency,
+    )
+    dialect = (
+        connection.get_bind().dialect if isinstance(connection, Session)
+        else connection.dialect
+    )
+    upsert = UPSERTS.get(dialect.name)
+    if upsert and dialect.insert_returning:
+        fee_id = connection.execute(
+            upsert(fees).values(values)
+            .on_conflict_do_nothing(
+                index_elements=[fees.c.amount, fees.c.currency],
+            )
+            .returning(fees.c.id),
+        ).scalar_one_or_none()
+        if fee_id is None:
+            fee_id = connection.execute(existing).scalar_one()
+        return fee_id
+    try:
+        with connection.begin_nested():
+            return connection.execute(
+                fees.insert().values(values),
+            ).inserted_primary_key[0]
+    except IntegrityError:
+        return connection.execute(existing).scalar_one()
+
+
+def delete_orphan_fees(
+        session: Session, fee_ids: Optional[Iterable[int]] = None,
+) -> List[int]:
+    fees, subscriptions = InternedFee.__table__, InternedSubscription.__table__
+    query = select(fees.c.id, fees.c.amount, fees.c.currency).where(
+        ~exists().where(subscriptions.c.fee_id == fees.c.id),
+    )
+    if fee_ids is not None:
+        query = query.where(fees.c.id.in_(fee_ids))
+    connection = session.connection()
+    orphans = connection.execute(query).all()
+    cache = fee_cache(session)
+    for chunk in chunked(orphans, SqlRepository.chunk_size):
+        connection.execute(
+            delete(fees).where(fees.c.id.in_([row.id for row in chunk])),
+        )
+        for row in chunk:
+            cache.invalidate(fee_key(row))
+    return [row.id for row in orphans]
+
+
+def expunge_fees(session: Session, fee_ids: Iterable[int]) -> None:
+    for fee_id in fee_ids:
+        fee = session.identity_map.get(identity_key(InternedFee, fee_id))
+        if fee is not None:
+            session.expunge(fee)
+
+
+# Registered for every session, so the unique constraint holds however the
+# interned models are flushed; sessions without them only pay for the scan.
+@listens_for(Session, 'before_flush')
+def intern_fees_before_flush(
+        session: Session, context: Any, instances: Optional[Sequence],
+) -> None:
+    orphans = set()
+    with session.no_autoflush:
+        for model in session.dirty:
+            if not isinstance(model, InternedSubscription):
+                continue
+            if inspect(model).attrs.fee.history.has_changes():
+                orphans.add(model.fee_id)
+        for model in session.deleted:
+            if isinstance(model, InternedSubscription):
+                orphans.add(model.fee_id)
+
+        interned: Dict[FeeKey, InternedFee] = {}
+        for model in [*session.new, *session.dirty]:
+            if not isinstance(model, InternedSubscription):
+                continue
+            fee = inspect(model).dict.get('fee')
+            if fee is None or not inspect(fee).pending:
+                continue
+            key = fee_key(fee)
+            if key not in interned:
+                interned[key] = intern_fee(session, fee)
+            model.fee = interned[key]
+            if fee in session:
+                session.expunge(fee)
+    orphans.discard(None)
+    if orphans:
+        session.info.setdefault('orphan_fee_ids', set()).update(orphans)
+
+
+@listens_for(Session, 'after_flush')
+def collect_fees_after_flush(session: Session, context: Any) -> None:
+    orphans = session.info.pop('orphan_fee_ids', None)
+    if orphans:
+        session.info['collected_fee_ids'] = delete_orphan_fees(
+            session, orphans,
+        )
+
+
+@listens_for(Session, 'after_flush_postexec')
+def expunge_fees_after_flush(session: Session, context: Any) -> None:
+    collected = session.info.pop('collected_fee_ids', None)
+    if collected:
+        expunge_fees(session, collected)
+
+
+class Repository(SqlRepository, entity.Repository):
+    model: Type[Union[Subscription, InternedSubscription]] = Subscription
+    fee_model: Type[Union[Fee, InternedFee]] = Fee
+    dto = entity.Subscription
+    money_dto = entity.Money
+    fee_total_dto = entity.FeeTotal
+    fee_loaders = loaders(Subscription.fee)
+
+    def __init__(
+            self,
+            session: Union[Session, scoped_session],
+            loading: Loading = 'joined',
+            intern_fees: bool = False,
+    ) -> None:
+        super().__init__(session, loading)
+        self._intern_fees = intern_fees
+        if intern_fees:
+            self.model = InternedSubscription
+            self.fee_model = InternedFee
+            self.fee_loaders = INTERNED_FEE_LOADERS
+
+    def create(
+            self, name: Text, fee: entity.Money,
+    ) -> Union[Subscription, InternedSubscription]:
+        return self.model(id=uuid1(), name=name, fee=fee)
+
+    def find(
+            self,
+            name: Text,
+            for_update: bool = True,
+            loading: Optional[Loading] = None,
+    ) -> Optional[entity.Subscription]:
+        query = self.query.options(*self._options(loading))
+        query = query.filter_by(name=name)
+        if for_update:
+            query = query.with_for_update()
+        return query.one_or_none()
+
+    def reprice(self, criterion: ColumnElement, fee: entity.Money) -> int:
+        if self._intern_fees:
+            return self._reprice_interned(criterion, fee)
+        fee_ids = select(Subscription.fee_id).where(criterion)
+        self._session.execute(
+            update(Fee)
+            .where(Fee.id.in_(fee_ids))
+            .values(amount=fee.amount, currency=fee.currency)
+            .execution_options(synchronize_session='fetch'),
+        )
+        repriced = self._session.execute(
+            update(Subscription)
+            .where(criterion)
+            .values(when_updated=datetime.utcnow())
+            .execution_options(synchronize_session='fetch'),
+        ).rowcount
+        self._commit()
+        return repriced
+
+    def collect_garbage(self) -> int:
+        if not self._intern_fees:
+            return 0
+        collected = delete_orphan_fees(self._session)
+        expunge_fees(self._session, collected)
+        self._commit()
+        return len(collected)
+
+    def _reprice_interned(
+            self, criterion: ColumnElement, fee: entity.Money,
+    ) -> int:
+        interned = intern_fee(self._session, fee)
+        old_fee_ids = set(self._session.scalars(
+            select(InternedSubscription.fee_id).where(criterion).distinct(),
+        ))
+        repriced = self._session.execute(
+            update(InternedSubscription)
+            .where(criterion)
+            .values(fee_id=interned.id, when_updated=datetime.utcnow())
+            .execution_options(synchronize_session='fetch'),
+        ).rowcount
+        for model in list(self._session.identity_map.values()):
+            if not isinstance(model, InternedSubscription):
+                continue
+            if inspect(model).dict.get('fee_id') == interned.id:
+                self._session.expire(model, ['fee'])
+        old_fee_ids.discard(interned.id)
+        expunge_fees(
+            self._session, delete_orphan_fees(self._session, old_fee_ids),
+        )
+        self._commit()
+        return repriced
+
+    def _expunge(self, model: Subscription) -> None:
+        fee = inspect(model).dict.get('fee')
+        super()._expunge(model)
+        if fee is not None and fee in self._session:
+            self._session.expunge(fee)
+
+    def _projection(self) -> Select:
+        subscriptions, fees = self.model.__table__, self.fee_model.__table__
+        return select(
+            subscriptions.c.id, subscriptions.c.name,
+            fees.c.amount, fees.c.currency,
+        ).join_from(subscriptions, fees)
 
     def save(self, model: Subscription) -> None:
         self._session.add(model)
-        try:
-            self._session.commit()
-        except:
-            self._session.rollback()
-            raise
+        self._commit()
+
 
+INTERNED_FEE_LOADERS = loaders(InternedSubscription.fee)
 
 table = Subscription.__table__
 fee_table = Fee.__table__
-__all__ = ['Repository', 'table', 'fee_table']
+interned_table = InternedSubscription.__table__
+interned_fee_table = InternedFee.__table__
+__all__ = [
+    'Repository', 'table', 'fee_table', 'interned_table', 'interned_fee_table',
+]
@@ -1,26 +1,35 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from decimal import Decimal
 from random import choice, randrange
-from typing import Tuple
+from typing import Iterator, List, Tuple
 from unittest.case import TestCase
 from uuid import UUID, uuid1
 
-from sqlalchemy import Column
+from sqlalchemy import Column, delete, inspect, select
+from sqlalchemy.event import listen, remove
 from sqlalchemy.orm import sessionmaker
 
 from . import model
+from cache import CacheStats
 from db import memory_engine, metadata
-from .entity import Currency, Money, Subscription
-
-TABLE = model.Subscription.__table__
-AMOUNT_C = model.fee_table.c.amount
-CURRENCY_C = model.fee_table.c.currency
+from ..cache import CachedRepository
+from .entity import Currency, FeeTotal, Money, Subscription
+from .migration import migrate_to_interned
 
 
 class TestMutableSeparateTableMapping(TestCase):
+    intern_fees = False
+
     def setUp(self) -> None:
         metadata.create_all(memory_engine)
         self.session = sessionmaker(bind=memory_engine)()
-        self.repository = model.Repository(self.session)
+        self.repository = model.Repository(
+            self.session, intern_fees=self.intern_fees,
+        )
+        self.fee_model = self.repository.fee_model
+        self.table = self.repository.model.__table__
+        self.fee_table = self.fee_model.__table__
 
     def tearDown(self) -> None:
         metadata.drop_all(memory_engine)
@@ -33,7 +42,8 @@ class TestMutableSeparateTableMapping(TestCase):
         self.repository.save(subscription)
 
         db_amount, db_currency = self.get_db_values(
-            subscription.id, AMOUNT_C, CURRENCY_C,
+            subscription.id, self.fee_table.c.amount,
+            self.fee_table.c.currency,
         )
         self.assertAlmostEqual(float(db_amount), float(new_fee.amount))
         self.assertEqual(db_currency, new_fee.currency)
@@ -46,7 +56,8 @@ class TestMutableSeparateTableMapping(TestCase):
         self.repository.save(subscription)
 
         db_amount, db_currency = self.get_db_values(
-            subscription.id, AMOUNT_C, CURRENCY_C,
+            subscription.id, self.fee_table.c.amount,
+            self.fee_table.c.currency,
         )
         self.assertAlmostEqual(float(db_amount), float(other.fee.amount))
         self.assertEqual(db_currency, other.fee.currency)
@@ -62,9 +73,9 @@ class TestMutableSeparateTableMapping(TestCase):
         subscription.fee = newest_fee
         self.repository.save(subscription)
 
-        number_of_stored_fees = self.session.query(model.Fee).count()
+        number_of_stored_fees = self.session.query(self.fee_model).count()
         self.assertEqual(number_of_stored_fees, 1)
-        db_fee = self.session.query(model.Fee).one()
+        db_fee = self.session.query(self.fee_model).one()
 
         assert db_fee == newest_fee
         self.assertAlmostEqual(db_fee, newest_fee)
@@ -75,24 +86,416 @@ class TestMutableSeparateTableMapping(TestCase):
 
         self.session.delete(subscription)
 
-        number_of_stored_fees = self.session.query(model.Fee).count()
+        number_of_stored_fees = self.session.query(self.fee_model).count()
         self.assertEqual(number_of_stored_fees, 0)
 
+    def test_find_many_by_names(self) -> None:
+        ids = {
+            subscription.name: subscription.id
+            for subscription in (
+                self.given_active_subscription() for _ in range(3)
+            )
+        }
+        self.session.expunge_all()
+
+        found = self.repository.find_many([*ids, 'missing'])
+
+        self.assertEqual(set(found), set(ids))
+        for name, subscription_id in ids.items():
+            self.assertEqual(found[name].id, subscription_id)
+            self.assertNotIn('fee', inspect(found[name]).unloaded)
+
+    def test_save_many_in_single_transaction(self) -> None:
+        commits = []
+        listen(self.session, 'after_commit', commits.append)
+        subscriptions = [self.given_new_subscription() for _ in range(5)]
+
+        self.repository.save_many(subscriptions, chunk_size=2)
+
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(self.session.query(self.repository.model).count(), 5)
+
+    def test_unit_of_work_postpones_commit(self) -> None:
+        with self.assertRaises(RuntimeError):
+            with self.repository.unit_of_work():
+                self.repository.save(self.given_new_subscription())
+                self.repository.save(self.given_new_subscription())
+                raise RuntimeError
+
+        self.assertEqual(self.session.query(self.repository.model).count(), 0)
+
+    def test_fee_loading_strategies(self) -> None:
+        names = [self.given_active_subscription().name for _ in range(3)]
+        expected_statements = {'joined': 1, 'selectin': 2, 'lazy': 4}
+
+        for loading, expected in expected_statements.items():
+            with self.subTest(loading):
+                self.session.expunge_all()
+                with self.statements() as statements:
+                    found = self.repository.find_many(names, loading=loading)
+                    fees = [model.fee for model in found.values()]
+                self.assertEqual(len(fees), 3)
+                self.assertEqual(len(statements), expected)
+
+    def test_find_joins_fee_by_default(self) -> None:
+        name = self.given_active_subscription().name
+        self.session.expunge_all()
+
+        with self.statements() as statements:
+            fee = self.repository.find(name).fee
+
+        self.assertIsNotNone(fee)
+        self.assertEqual(len(statements), 1)
+
+    def test_read_plain_entities(self) -> None:
+        subscription = self.given_active_subscription()
+        name, subscription_id = subscription.name, subscription.id
+        self.session.expunge_all()
+
+        found = self.repository.read(name)
+
+        self.assertIs(type(found), Subscription)
+        self.assertIs(type(found.fee), Money)
+        self.assertEqual(found.id, subscription_id)
+        self.assertIsNone(self.repository.read('missing'))
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_read_all_streams_entities(self) -> None:
+        names = sorted(
+            self.given_active_subscription().name for _ in range(5)
+        )
+        self.session.expunge_all()
+
+        found = list(self.repository.read_all(batch_size=2))
+
+        self.assertEqual([dto.name for dto in found], names)
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_cached_find_invalidated_on_save(self) -> None:
+        repository = CachedRepository(self.repository, maxsize=10)
+        subscription = self.given_active_subscription()
+        name = subscription.name
+
+        first = repository.find(name, for_update=False)
+        second = repository.find(name, for_update=False)
+        subscription.fee = Money(Decimal('11.3'), Currency('PLN'))
+        repository.save(subscription)
+        third = repository.find(name, for_update=False)
+
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual(third.fee.currency, 'PLN')
+        self.assertEqual(
+            repository.stats, CacheStats(hits=1, misses=2, evictions=0),
+        )
+
+    def test_cached_find_ignores_rolled_back_changes(self) -> None:
+        repository = CachedRepository(self.repository, maxsize=10)
+        subscription = self.given_active_subscription()
+        name = subscription.name
+        original = repository.find(name, for_update=False).fee
+
+        with self.assertRaises(RuntimeError):
+            with repository.unit_of_work():
+                subscription.fee = Money(Decimal('99.00'), Currency('EUR'))
+                repository.save(subscription)
+                found = repository.find(name, for_update=False)
+                self.assertEqual(found.fee.amount, Decimal('99.00'))
+                raise RuntimeError
+
+        self.assertEqual(repository.find(name, for_update=False).fee, original)
+        self.assertEqual(self.repository.read(name).fee, original)
+
+    def test_iter_all_in_keyset_batches(self) -> None:
+        names = sorted(
+            self.given_active_subscription().name for _ in range(5)
+        )
+        self.session.expunge_all()
+
+        batches = []
+        for batch in self.repository.iter_all(batch_size=2, after=names[0]):
+            batches.append([subscription.name for subscription in batch])
+            self.assertEqual(len(self.session.identity_map), 2 * len(batch))
+
+        self.assertEqual(batches, [names[1:3], names[3:5]])
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_iter_all_expunges_batch_when_loop_stops_early(self) -> None:
+        for _ in range(3):
+            self.given_active_subscription()
+        self.session.expunge_all()
+
+        for batch in self.repository.iter_all(batch_size=2):
+            break
+        with self.assertRaises(RuntimeError):
+            for batch in self.repository.iter_all(batch_size=2):
+                raise RuntimeError
+
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_iter_all_with_lazy_fees(self) -> None:
+        self.given_active_subscription()
+        self.session.expunge_all()
+        repository = model.Repository(
+            self.session, loading='lazy', intern_fees=self.intern_fees,
+        )
+
+        batches = list(repository.iter_all())
+
+        self.assertEqual(len(batches[0]), 1)
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_fee_totals_per_currency(self) -> None:
+        for name, amount, currency in [
+            ('basic-1', '10.50', 'EUR'),
+            ('basic-2', '4.25', 'EUR'),
+            ('pro-1', '99.99', 'USD'),
+        ]:
+            fee = Money(Decimal(amount), Currency(currency))
+            self.repository.save(self.repository.create(name, fee))
+        self.session.expunge_all()
+        tomorrow = datetime.utcnow() + timedelta(days=1)
+
+        totals = self.repository.fee_totals()
+        pro_totals = self.repository.fee_totals(name_like='pro-%')
+        future_totals = self.repository.fee_totals(created_from=tomorrow)
+
+        self.assertEqual(totals, [
+            FeeTotal(Money(Decimal('14.75'), Currency('EUR')), 2),
+            FeeTotal(Money(Decimal('99.99'), Currency('USD')), 1),
+        ])
+        self.assertEqual(pro_totals, [
+            FeeTotal(Money(Decimal('99.99'), Currency('USD')), 1),
+        ])
+        self.assertEqual(future_totals, [])
+        self.assertEqual(len(self.session.identity_map), 0)
+
+    def test_reprice_with_set_based_update(self) -> None:
+        basic = [self.given_active_subscription() for _ in range(3)]
+        other = self.given_active_subscription()
+        names = [subscription.name for subscription in basic]
+        new_fee = Money(Decimal('19.99'), Currency('PLN'))
+
+        with self.repository.unit_of_work():
+            loaded = self.repository.find(names[0])
+            self.assertIsNotNone(loaded.fee)
+            with self.statements() as statements:
+                repriced = self.repository.reprice(
+                    self.table.c.name.in_(names), new_fee,
+                )
+            self.assertEqual(loaded.fee, new_fee)
+
+        self.assertEqual(repriced, 3)
+        inserts = [s for s in statements if s.startswith('INSERT')]
+        self.assertEqual(inserts, [])
+        self.assertEqual(self.session.query(self.fee_model).count(), 4)
+        for name in names:
+            found = self.repository.read(name)
+            self.assertEqual(found.fee, new_fee)
+        self.assertNotEqual(self.repository.read(other.name).fee, new_fee)
+        when_updated = self.session.execute(
+            select(self.table.c.when_updated)
+            .where(self.table.c.id == basic[0].id),
+        ).scalar_one()
+        self.assertIsNotNone(when_updated)
+
+    def test_saves_equal_fees_outside_repository(self) -> None:
+        fee = Money(Decimal('10.50'), Currency('EUR'))
+        session = sessionmaker(bind=memory_engine)()
+        session.add_all([
+            self.repository.model(id=uuid1(), name=name, fee=fee)
+            for name in ('first', 'second')
+        ])
+        session.commit()
+
+        for name in ('first', 'second'):
+            self.assertEqual(self.repository.read(name).fee, fee)
+
+    def test_assigning_equal_fee_writes_nothing(self) -> None:
+        subscription = self.given_active_subscription()
+        fee = subscription.fee
+
+        subscription.fee = Money(fee.amount, fee.currency)
+        self.assertFalse(self.session.is_modified(subscription))
+        with self.statements() as statements:
+            self.session.flush()
+
+        self.assertEqual(statements, [])
+        self.assertIsNone(subscription.when_updated)
+
     def given_active_subscription(self) -> Subscription:
+        subscription = self.given_new_subscription()
+        self.repository.save(subscription)
+        return subscription
+
+    def given_new_subscription(self) -> Subscription:
         fee = Money(
-            amount=Decimal(randrange(1000, 53400)/100),
+            amount=Decimal(randrange(1000, 53400)).scaleb(-2),
             currency=choice([Currency('EUR'), Currency('GBP'), Currency('USD')])
         )
         name = uuid1().hex
-        subscription = self.repository.create(name, fee)
-        self.repository.save(subscription)
-        return subscription
+        return self.repository.create(name, fee)
+
+    @contextmanager
+    def statements(self) -> Iterator[List[str]]:
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args) -> None:
+            statements.append(statement)
+
+        listen(memory_engine, 'before_cursor_execute', before_execute)
+        try:
+            yield statements
+        finally:
+            remove(memory_engine, 'before_cursor_execute', before_execute)
 
     def get_db_values(self, subscription_id: UUID, *columns: Column) -> Tuple:
         self.session.expire_all()
         query = (
             self.session.query(*columns)
-            .join(TABLE, TABLE.c.fee_id == model.fee_table.c.id)
-            .filter(TABLE.c.id == subscription_id)
+            .join(self.table, self.table.c.fee_id == self.fee_table.c.id)
+            .filter(self.table.c.id == subscription_id)
         )
         return query.one()
+
+
+class TestInternedFees(TestMutableSeparateTableMapping):
+    intern_fees = True
+
+    def test_shares_fee_rows_with_equal_value(self) -> None:
+        fee = Money(Decimal('10.50'), Currency('EUR'))
+        first = self.repository.create('first', fee)
+        second = self.repository.create('second', fee)
+        self.repository.save_many([first, second])
+
+        with self.statements() as statements:
+            third = self.repository.create('third', fee)
+            self.repository.save(third)
+
+        self.assertEqual(self.session.query(self.fee_model).count(), 1)
+        self.assertEqual(first.fee_id, third.fee_id)
+        fee_statements = [
+            statement for statement in statements
+            if 'mutable_separate_vo_interned_fees' in statement
+        ]
+        self.assertEqual(len(fee_statements), 1)
+        self.assertIn(
+            'WHERE mutable_separate_vo_interned_fees.id = ?',
+            fee_statements[0],
+        )
+
+    def test_cached_fee_deleted_elsewhere_is_not_reused(self) -> None:
+        fee = Money(Decimal('10.50'), Currency('EUR'))
+        first = self.repository.create('first', fee)
+        self.repository.save(first)
+        self.session.execute(delete(self.table))
+        self.session.execute(delete(self.fee_table))
+        self.session.commit()
+
+        second = self.repository.create('second', fee)
+        self.repository.save(second)
+
+        db_fee = self.session.query(self.fee_model).one()
+        self.assertEqual(db_fee.id, second.fee_id)
+        self.assertEqual(db_fee, fee)
+
+    def test_interns_fees_outside_repository(self) -> None:
+        fee = Money(Decimal('10.50'), Currency('EUR'))
+        session = sessionmaker(bind=memory_engine)()
+        first = model.InternedSubscription(id=uuid1(), name='first', fee=fee)
+        second = model.InternedSubscription(
+            id=uuid1(), name='second', fee=fee,
+        )
+        session.add_all([first, second])
+        session.commit()
+
+        self.assertEqual(first.fee_id, second.fee_id)
+        session.delete(first)
+        session.delete(second)
+        session.commit()
+        self.assertEqual(self.session.query(self.fee_model).count(), 0)
+
+    def test_migrates_subscriptions_to_interned_fees(self) -> None:
+        plain = model.Repository(self.session)
+        fees = [
+            Money(Decimal('10.50'), Currency('EUR')),
+            Money(Decimal('10.50'), Currency('EUR')),
+            Money(Decimal('4.25'), Currency('USD')),
+        ]
+        for index, fee in enumerate(fees):
+            plain.save(plain.create(f'plan-{index}', fee))
+        plain.save(plain.create('taken', fees[0]))
+        self.repository.save(self.repository.create('taken', fees[2]))
+        self.session.close()
+
+        migrated = migrate_to_interned(memory_engine, batch_size=2)
+
+        self.assertEqual(migrated, 3)
+        for index, fee in enumerate(fees):
+            self.assertEqual(self.repository.read(f'plan-{index}').fee, fee)
+        self.assertEqual(self.repository.read('taken').fee, fees[2])
+        self.assertEqual(self.session.query(self.fee_model).count(), 2)
+        self.assertEqual(
+            [subscription.name for subscription in plain.read_all()],
+            ['taken'],
+        )
+        self.assertEqual(self.session.query(model.Fee).count(), 1)
+
+    def test_keeps_shared_fee_until_last_reference_is_gone(self) -> None:
+        fee = Money(Decimal('10.50'), Currency('EUR'))
+        first = self.repository.create('first', fee)
+        second = self.repository.create('second', fee)
+        self.repository.save_many([first, second])
+
+        first.fee = Money(Decimal('11.3'), Currency('PLN'))
+        self.repository.save(first)
+        self.assertEqual(self.session.query(self.fee_model).count(), 2)
+
+        self.session.delete(second)
+        self.assertEqual(self.session.query(self.fee_model).count(), 1)
+
+        second = self.repository.create('second', fee)
+        self.repository.save(second)
+        self.assertEqual(second.fee, fee)
+
+    def test_collect_garbage_deletes_orphan_fees(self) -> None:
+        subscription = self.given_active_subscription()
+        self.session.execute(self.fee_table.insert(), [
+            {'amount': Decimal('1.00'), 'currency': 'EUR'},
+            {'amount': Decimal('2.00'), 'currency': 'EUR'},
+        ])
+
+        collected = self.repository.collect_garbage()
+
+        self.assertEqual(collected, 2)
+        db_fee = self.session.query(self.fee_model).one()
+        self.assertEqual(db_fee.id, subscription.fee_id)
+
+    def test_reprice_with_set_based_update(self) -> None:
+        basic = [self.given_active_subscription() for _ in range(3)]
+        other = self.given_active_subscription()
+        names = [subscription.name for subscription in basic]
+        new_fee = Money(Decimal('19.99'), Currency('PLN'))
+
+        with self.repository.unit_of_work():
+            loaded = self.repository.find(names[0])
+            self.assertIsNotNone(loaded.fee)
+            with self.statements() as statements:
+                repriced = self.repository.reprice(
+                    self.table.c.name.in_(names), new_fee,
+                )
+            self.assertEqual(loaded.fee, new_fee)
+
+        self.assertEqual(repriced, 3)
+        inserts = [s for s in statements if s.startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.session.query(self.fee_model).count(), 2)
+        for name in names:
+            found = self.repository.read(name)
+            self.assertEqual(found.fee, new_fee)
+        self.assertNotEqual(self.repository.read(other.name).fee, new_fee)
+        when_updated = self.session.execute(
+            select(self.table.c.when_updated)
+            .where(self.table.c.id == basic[0].id),
+        ).scalar_one()
+        self.assertIsNotNone(when_updated)
@@ -5,18 +5,24 @@ from uuid import uuid1
 from sqlalchemy import (
     Column,
     DateTime,
-    Float,
     ForeignKey,
+    inspect,
     Integer,
+    select,
+    Select,
     String,
     Table,
+    update,
 )
 from sqlalchemy.event import listens_for
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy.orm import relationship
 from sqlalchemy.orm.attributes import Event
-from sqlalchemy_utils import CurrencyType, UUIDType
+from sqlalchemy.sql import ColumnElement
+from sqlalchemy_utils import UUIDType
 
 from db import Base
+from ..repository import loaders, Loading, SqlRepository
+from ..types import InternedCurrencyType, MinorUnits
 from . import entity
 
 
@@ -25,8 +31,8 @@ class Fee(entity.Money, Base):
     __tablename__ = 'mutable_separate_vo_fees'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    amount = Column(Float(asdecimal=True), nullable=False)
-    currency = Column(CurrencyType, nullable=False)
+    amount = Column(MinorUnits(), nullable=False)
+    currency = Column(InternedCurrencyType(), nullable=False)
 
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, entity.Money):
@@ -57,30 +63,67 @@ def convert_money_to_fee_on_set(
 ) -> Fee:
     if old is None:
         return Fee(value.amount, value.currency)
-    else:
+    elif old != value:
         old.amount = value.amount
         old.currency = value.currency
-        return old
+    return old
 
 
-class Repository(entity.Repository):
-    def __init__(self, session: Session) -> None:
-        self._session = session
-        self.query = session.query(Subscription)
+class Repository(SqlRepository, entity.Repository):
+    model = Subscription
+    dto = entity.Subscription
+    money_dto = entity.Money
+    fee_total_dto = entity.FeeTotal
+    fee_loaders = loaders(Subscription.fee)
 
     def create(self, name: Text, fee: entity.Money) -> Subscription:
         return Subscription(id=uuid1(), name=name, fee=fee)
 
-    def find(self, name: Text) -> Optional[entity.Subscription]:
-        return self.query.with_for_update().filter_by(name=name).one_or_none()
+    def find(
+            self,
+            name: Text,
+            for_update: bool = True,
+            loading: Optional[Loading] = None,
+    ) -> Optional[entity.Subscription]:
+        query = self.query.options(*self._options(loading))
+        query = query.filter_by(name=name)
+        if for_update:
+            query = query.with_for_update()
+        return query.one_or_none()
+
+    def reprice(self, criterion: ColumnElement, fee: entity.Money) -> int:
+        fee_ids = select(Subscription.fee_id).where(criterion)
+        self._session.execute(
+            update(Fee)
+            .where(Fee.id.in_(fee_ids))
+            .values(amount=fee.amount, currency=fee.currency)
+            .execution_options(synchronize_session='fetch'),
+        )
+        repriced = self._session.execute(
+            update(Subscription)
+            .where(criterion)
+            .values(when_updated=datetime.utcnow())
+            .execution_options(synchronize_session='fetch'),
+        ).rowcount
+        self._commit()
+        return repriced
+
+    def _expunge(self, model: Subscription) -> None:
+        fee = inspect(model).dict.get('fee')
+        super()._expunge(model)
+        if fee is not None and fee in self._session:
+            self._session.expunge(fee)
+
+    def _projection(self) -> Select:
+        subscriptions, fees = Subscription.__table__, Fee.__table__
+        return select(
+            subscriptions.c.id, subscriptions.c.name,
+            fees.c.amount, fees.c.currency,
+        ).join_from(subscriptions, fees)
 
     def save(self, model: Subscription) -> None:
         self._session.add(model)
-        try:
-            self._session.commit()
-        except:
-            self._session.rollback()
-            raise
+        self._commit()
 
 
 table = Subscription.__table__
@@ -0,0 +1,306 @@
+from decimal import Decimal
+from tempfile import TemporaryDirectory
+from typing import List, Union
+from unittest import TestCase
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    create_engine,
+    Float,
+    ForeignKey,
+    func,
+    inspect,
+    Integer,
+    MetaData,
+    select,
+    String,
+    Table,
+)
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import IntegrityError, StatementError
+from sqlalchemy_utils import Currency
+
+from db import make_engine
+from .migration import convert_to_minor_units, deduplicate
+from .repository import SqlRepository
+from .types import InternedCurrencyType, intern_currency, MinorUnits
+
+
+class TestInternedCurrencyType(TestCase):
+    def setUp(self) -> None:
+        self.engine = create_engine('sqlite:///')
+        self.metadata = MetaData()
+        self.table = Table(
+            'prices', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('code', InternedCurrencyType()),
+            Column('number', InternedCurrencyType(as_integer=True)),
+        )
+        self.metadata.create_all(self.engine)
+
+    def test_loaded_currencies_are_interned(self) -> None:
+        rows = self.store('PLN', Currency('PLN'), 'EUR')
+
+        self.assertIs(rows[0].code, rows[1].code)
+        self.assertIs(rows[0].number, rows[1].number)
+        self.assertIs(rows[0].code, intern_currency('PLN'))
+        self.assertEqual(rows[2].code, Currency('EUR'))
+
+    def test_integer_storage(self) -> None:
+        rows = self.store('USD', 'ZWL', 'AED')
+
+        self.assertEqual([row.number for row in rows], ['USD', 'ZWL', 'AED'])
+        with self.engine.connect() as connection:
+            raw = connection.exec_driver_sql('SELECT number FROM prices')
+            self.assertTrue(all(isinstance(n, int) for n, in raw))
+
+    def test_rejects_invalid_code(self) -> None:
+        with self.assertRaises(StatementError):
+            self.store('XYZ')
+
+    def store(self, *codes: Union[str, Currency]) -> List[Row]:
+        with self.engine.begin() as connection:
+            connection.execute(self.table.insert(), [
+                {'code': code, 'number': code} for code in codes
+            ])
+            query = select(self.table).order_by(self.table.c.id)
+            return connection.execute(query).all()
+
+
+class TestMinorUnits(TestCase):
+    def setUp(self) -> None:
+        self.engine = create_engine('sqlite:///')
+        self.metadata = MetaData()
+
+    def test_stores_exact_integer_minor_units(self) -> None:
+        prices = Table(
+            'prices', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('amount', MinorUnits()),
+        )
+        self.metadata.create_all(self.engine)
+        amounts = [Decimal('12.34'), 12.34, Decimal('0.3'), 7]
+
+        with self.engine.begin() as connection:
+            connection.execute(prices.insert(), [
+                {'amount': amount} for amount in amounts
+            ])
+            loaded = connection.execute(
+                select(prices.c.amount).order_by(prices.c.id),
+            ).scalars().all()
+            raw = connection.exec_driver_sql('SELECT amount FROM prices')
+            total = connection.execute(
+                select(func.sum(prices.c.amount)),
+            ).scalar()
+
+        self.assertEqual(
+            loaded,
+            [Decimal('12.34'), Decimal('12.34'), Decimal('0.30'),
+             Decimal('7.00')],
+        )
+        self.assertEqual([amount for amount, in raw], [1234, 1234, 30, 700])
+        self.assertEqual(total, Decimal('31.98'))
+
+    def test_rejects_amounts_it_cannot_store_exactly(self) -> None:
+        prices = Table(
+            'prices', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('amount', MinorUnits()),
+            Column('dinars', MinorUnits(exponent=3)),
+        )
+        self.metadata.create_all(self.engine)
+
+        with self.engine.begin() as connection:
+            connection.execute(prices.insert(), {'dinars': Decimal('1.005')})
+            for amount in [Decimal('1.005'), Decimal(12.34), 0.1 + 0.2]:
+                with self.subTest(amount):
+                    with self.assertRaisesRegex(StatementError, 'places'):
+                        connection.execute(
+                            prices.insert(), {'amount': amount},
+                        )
+            raw = connection.exec_driver_sql('SELECT dinars FROM prices')
+
+            self.assertEqual([dinars for dinars, in raw], [1005])
+
+    def test_migrates_float_column(self) -> None:
+        legacy = Table(
+            'legacy_fees', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', String(20), index=True),
+            Column('amount', Float, nullable=False),
+        )
+        self.metadata.create_all(self.engine)
+        amounts = [12.34, 0.1 + 0.2, 533.99, 10.005, 1]
+
+        with self.engine.begin() as connection:
+            connection.execute(legacy.insert(), [
+                {'amount': amount} for amount in amounts
+            ])
+            converted = convert_to_minor_units(
+                connection, 'legacy_fees', 'amount', batch_size=2,
+            )
+            raw = connection.exec_driver_sql(
+                'SELECT amount FROM legacy_fees ORDER BY id',
+            )
+
+            self.assertEqual(converted, 5)
+            self.assertEqual(
+                [amount for amount, in raw], [1234, 30, 53399, 1000, 100],
+            )
+            schema = inspect(connection)
+            amount, = [
+                column for column in schema.get_columns('legacy_fees')
+                if column['name'] == 'amount'
+            ]
+            indexes = schema.get_indexes('legacy_fees')
+
+        self.assertIsInstance(amount['type'], BigInteger)
+        self.assertFalse(amount['nullable'])
+        self.assertEqual(
+            [index['column_names'] for index in indexes], [['name']],
+        )
+
+
+    def test_migrates_columns_of_tables_with_foreign_keys(self) -> None:
+        fees = Table(
+            'mutable_separate_vo_fees', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('amount', Float, nullable=False),
+            Column('currency', String(3), nullable=False),
+        )
+        plans = Table(
+            'mutable_separate_vo_subscription_plans', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('setup_fee', Float, nullable=False),
+            Column('fee_id', Integer, ForeignKey(fees.c.id), nullable=False),
+        )
+        with TemporaryDirectory() as directory:
+            engine = make_engine(f'sqlite:///{directory}/fees.db')
+            self.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(fees.insert(), [
+                    {'id': 1, 'amount': 10.5, 'currency': 'EUR'},
+                    {'id': 2, 'amount': 0.1 + 0.2, 'currency': 'PLN'},
+                ])
+                connection.execute(plans.insert(), [
+                    {'id': 1, 'setup_fee': 1.99, 'fee_id': 2},
+                    {'id': 2, 'setup_fee': 0, 'fee_id': 1},
+                ])
+
+            with engine.connect() as connection:
+                converted = [
+                    convert_to_minor_units(
+                        connection, fees.name, 'amount', batch_size=1,
+                    ),
+                    convert_to_minor_units(
+                        connection, plans.name, 'setup_fee', batch_size=1,
+                    ),
+                ]
+            with engine.connect() as connection:
+                amounts = connection.execute(
+                    select(plans.c.setup_fee, fees.c.amount)
+                    .join_from(plans, fees).order_by(plans.c.id),
+                ).all()
+                foreign_keys = connection.exec_driver_sql(
+                    'PRAGMA foreign_keys',
+                ).scalar()
+                references = inspect(connection).get_foreign_keys(plans.name)
+                with self.assertRaises(IntegrityError):
+                    connection.execute(
+                        plans.insert(), {'setup_fee': 0, 'fee_id': 3},
+                    )
+            engine.dispose()
+
+        self.assertEqual(converted, [2, 2])
+        self.assertEqual(amounts, [(199, 30), (0, 1050)])
+        self.assertEqual(foreign_keys, 1)
+        self.assertEqual(
+            [(reference['referred_table'], reference['constrained_columns'])
+             for reference in references],
+            [(fees.name, ['fee_id'])],
+        )
+
+    def test_refuses_to_disable_foreign_keys_in_transaction(self) -> None:
+        legacy = Table(
+            'legacy_fees', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('amount', Float, nullable=False),
+        )
+        with TemporaryDirectory() as directory:
+            engine = make_engine(f'sqlite:///{directory}/fees.db')
+            self.metadata.create_all(engine)
+            with engine.connect() as connection:
+                connection.execute(legacy.insert(), {'amount': 1.5})
+                with self.assertRaises(RuntimeError):
+                    convert_to_minor_units(connection, 'legacy_fees', 'amount')
+            engine.dispose()
+
+
+class TestDeduplicate(TestCase):
+    def setUp(self) -> None:
+        self.engine = create_engine('sqlite:///')
+        self.metadata = MetaData()
+        self.fees = Table(
+            'legacy_fees', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('amount', Integer, nullable=False),
+            Column('currency', String(3), nullable=False),
+        )
+        self.plans = Table(
+            'legacy_plans', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('fee_id', Integer, ForeignKey('legacy_fees.id')),
+        )
+        self.metadata.create_all(self.engine)
+
+    def test_merges_duplicates_and_adds_constraint(self) -> None:
+        with self.engine.begin() as connection:
+            connection.execute(self.fees.insert(), [
+                {'id': 1, 'amount': 1050, 'currency': 'EUR'},
+                {'id': 2, 'amount': 1050, 'currency': 'EUR'},
+                {'id': 3, 'amount': 1050, 'currency': 'PLN'},
+                {'id': 4, 'amount': 1050, 'currency': 'EUR'},
+            ])
+            connection.execute(self.plans.insert(), [
+                {'id': 1, 'fee_id': 4},
+                {'id': 2, 'fee_id': 2},
+                {'id': 3, 'fee_id': 3},
+            ])
+            merged = deduplicate(
+                connection, 'legacy_fees', ['amount', 'currency'],
+                [('legacy_plans', 'fee_id')], 'fee_value', batch_size=1,
+            )
+            fee_ids = connection.execute(
+                select(self.fees.c.id).order_by(self.fees.c.id),
+            ).scalars().all()
+            plan_fee_ids = connection.execute(
+                select(self.plans.c.fee_id).order_by(self.plans.c.id),
+            ).scalars().all()
+
+        self.assertEqual(merged, 2)
+        self.assertEqual(fee_ids, [1, 3])
+        self.assertEqual(plan_fee_ids, [1, 1, 3])
+        with self.assertRaises(IntegrityError):
+            with self.engine.begin() as connection:
+                connection.execute(
+                    self.fees.insert(), {'amount': 1050, 'currency': 'EUR'},
+                )
+
+
+class TestSqlRepository(TestCase):
+    def test_missing_save_fails_on_instantiation(self) -> None:
+        class Repository(SqlRepository):
+            def _projection(self) -> None:
+                return None
+
+        with self.assertRaisesRegex(TypeError, 'save'):
+            Repository(None)
+
+    def test_missing_projection_fails_on_instantiation(self) -> None:
+        class Repository(SqlRepository):
+            def save(self, model: object) -> None:
+                pass
+
+        with self.assertRaisesRegex(TypeError, '_projection'):
+            Repository(None)
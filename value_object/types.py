@@ -0,0 +1,112 @@
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Dict, Optional, Text, Union
+
+from sqlalchemy import BigInteger, SmallInteger, String
+from sqlalchemy.engine import Dialect
+from sqlalchemy.types import TypeDecorator, TypeEngine
+from sqlalchemy_utils import Currency
+from sqlalchemy_utils.types.scalar_coercible import ScalarCoercible
+
+Amount = Union[Decimal, float, int]
+
+_currencies: Dict[Text, Currency] = {}
+
+
+def intern_currency(value: Union[Currency, Text]) -> Currency:
+    code = value.code if isinstance(value, Currency) else value
+    try:
+        return _currencies[code]
+    except KeyError:
+        return _currencies.setdefault(code, Currency(code))
+
+
+def currency_to_int(code: Text) -> int:
+    if len(code) != 3 or not code.isascii() or not code.isupper():
+        raise ValueError(f"'{code}' is not valid currency code.")
+    first, second, third = (ord(letter) - ord('A') for letter in code)
+    return (first * 26 + second) * 26 + third
+
+
+def int_to_currency(number: int) -> Text:
+    number, third = divmod(number, 26)
+    first, second = divmod(number, 26)
+    return ''.join(chr(ord('A') + index) for index in (first, second, third))
+
+
+class InternedCurrencyType(ScalarCoercible, TypeDecorator):
+    impl = String(3)
+    python_type = Currency
+    cache_ok = True
+
+    def __init__(self, as_integer: bool = False) -> None:
+        super().__init__()
+        self.as_integer = as_integer
+
+    def load_dialect_impl(self, dialect: Dialect) -> TypeEngine:
+        if self.as_integer:
+            return dialect.type_descriptor(SmallInteger())
+        return dialect.type_descriptor(self.impl)
+
+    def process_bind_param(
+            self, value: Optional[Union[Currency, Text]], dialect: Dialect,
+    ) -> Optional[Union[Text, int]]:
+        if value is None:
+            return None
+        code = intern_currency(value).code
+        return currency_to_int(code) if self.as_integer else code
+
+    def process_result_value(
+            self, value: Optional[Union[Text, int]], dialect: Dialect,
+    ) -> Optional[Currency]:
+        if value is None:
+            return None
+        if self.as_integer:
+            value = int_to_currency(value)
+        return intern_currency(value)
+
+    def _coerce(self, value: Any) -> Optional[Currency]:
+        return None if value is None else intern_currency(value)
+
+
+@lru_cache(maxsize=None)
+def quantizer(exponent: int) -> Decimal:
+    return Decimal(1).scaleb(-exponent)
+
+
+def to_minor_units(
+        amount: Amount, exponent: int, rounding: Optional[str] = None,
+) -> int:
+    if isinstance(amount, float):
+        amount = Decimal(repr(amount))
+    exact = Decimal(amount).quantize(quantizer(exponent), rounding)
+    if rounding is None and exact != amount:
+        raise ValueError(
+            f'{amount} has more than {exponent} decimal places, use a '
+            f'column with a larger exponent.'
+        )
+    return int(exact.scaleb(exponent))
+
+
+class MinorUnits(TypeDecorator):
+    impl = BigInteger
+    python_type = Decimal
+    cache_ok = True
+
+    def __init__(self, exponent: int = 2) -> None:
+        super().__init__()
+        self.exponent = exponent
+
+    def process_bind_param(
+            self, value: Optional[Amount], dialect: Dialect,
+    ) -> Optional[int]:
+        if value is None:
+            return None
+        return to_minor_units(value, self.exponent)
+
+    def process_result_value(
+            self, value: Optional[int], dialect: Dialect,
+    ) -> Optional[Decimal]:
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-self.exponent)